@@ -0,0 +1,129 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+NANOSECONDS = 10 ** 9
+
+
+def model_key(model):
+    return f'version:{model._meta.label_lower}'
+
+
+def user_state_key(user_id):
+    """Избранное, корзина и подписки пользователя."""
+
+    return f'version:user-state:{user_id}'
+
+
+def get_versions(keys):
+    """Текущие версии по ключам.
+
+    Версия — время последнего изменения в наносекундах, поэтому по ней же
+    считаем Last-Modified. Отсутствующую версию (кэш очищен или вытеснен)
+    заводим от текущего времени: она не совпадет ни с одной из прежних."""
+
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump(key):
+    """Сдвигаем версию: все закэшированные по ней ответы устаревают."""
+
+    version = max(cache.get(key, 0) + 1, time.time_ns())
+    cache.set(key, version, timeout=None)
+
+
+def bump_version(model):
+    bump(model_key(model))
+
+
+def bump_user_state(user_id):
+    bump(user_state_key(user_id))
+
+
+def request_fingerprint(request):
+    query = sorted(
+        (name, sorted(values))
+        for name, values in request.query_params.lists())
+    return (request.get_host(), request.path, query)
+
+
+def response_cache_key(request, models):
+    """Ключ ответа: путь, нормализованные параметры и версии таблиц."""
+
+    raw = repr((
+        request_fingerprint(request),
+        get_versions([model_key(model) for model in models])))
+    return 'response:' + hashlib.sha256(raw.encode()).hexdigest()
+
+
+class AnonymousCacheMixin:
+    """Кэш list/retrieve для анонимных запросов.
+
+    cache_models — таблицы, от которых зависит ответ вьюхи."""
+
+    cache_models = ()
+
+    def cached(self, handler, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+        key = response_cache_key(request, self.cache_models)
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, settings.API_CACHE_TIMEOUT)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(super().retrieve, request, *args, **kwargs)
+
+
+class ConditionalGetMixin:
+    """ETag и Last-Modified из версий таблиц, 304 без обращения к ORM.
+
+    Ответ зависит от cache_models и, для авторизованного пользователя,
+    от его избранного, корзины и подписок."""
+
+    cache_models = ()
+
+    def get_validators(self, request):
+        keys = [model_key(model) for model in self.cache_models]
+        user_id = request.user.id
+        if user_id is not None:
+            keys.append(user_state_key(user_id))
+        versions = get_versions(keys)
+        raw = repr((request_fingerprint(request), user_id, versions))
+        etag = '"%s"' % hashlib.sha256(raw.encode()).hexdigest()
+        return etag, max(versions) // NANOSECONDS
+
+    def conditional(self, handler, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request)
+        response = get_conditional_response(
+            request._request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            patch_vary_headers(response, ('Authorization',))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
@@ -0,0 +1,101 @@
+import re
+import threading
+from bisect import bisect_left
+
+from recipes.models import Ingredient, Tag
+
+from .cache import get_versions, model_key
+
+WORD_START = re.compile(r'(?<=[\s\-(,])\w')
+
+
+class Snapshot:
+    """Срез справочника: версия, строки и производные данные.
+
+    После сборки не меняется, так что поток, который держит срез,
+    видит согласованные данные, даже если справочник уже перечитали."""
+
+    def __init__(self, version, rows, **extra):
+        self.version = version
+        self.rows = rows
+        self.__dict__.update(extra)
+
+
+class Catalog:
+    """Справочник в памяти процесса: строки таблицы по id.
+
+    Перечитывается целиком, когда меняется версия таблицы в кэше,
+    так что проверка id не ходит в БД, пока справочник не менялся.
+    Новый срез подменяется одним присваиванием."""
+
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = fields
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def build(self, rows):
+        """Производные данные среза."""
+
+        return {}
+
+    def load(self, version):
+        rows = {
+            row['id']: row
+            for row in self.model.objects.values(*self.fields)}
+        return Snapshot(version, rows, **self.build(rows))
+
+    def snapshot(self):
+        version, = get_versions([model_key(self.model)])
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.version != version:
+                    snapshot = self._snapshot = self.load(version)
+        return snapshot
+
+    def get(self):
+        return self.snapshot().rows
+
+
+class IngredientCatalog(Catalog):
+    """Справочник ингредиентов с отсортированными индексами префиксов.
+
+    names — (название, id) в нижнем регистре, words — то же для каждого
+    слова внутри названия, начиная с него. Поиск — bisect по обоим."""
+
+    def build(self, rows):
+        names = []
+        words = []
+        for ingredient_id, row in rows.items():
+            name = row['name'].lower()
+            names.append((name, ingredient_id))
+            words.extend(
+                (name[match.start():], ingredient_id)
+                for match in WORD_START.finditer(name))
+        names.sort()
+        words.sort()
+        return {'names': names, 'words': words}
+
+    def search(self, query, limit):
+        """Сначала совпадения с началом названия, затем с началом слова."""
+
+        snapshot = self.snapshot()
+        rows = snapshot.rows
+        query = query.strip().lower()
+        found = {}
+        for index in (snapshot.names, snapshot.words):
+            position = bisect_left(index, (query,))
+            while position < len(index) and len(found) < limit:
+                key, ingredient_id = index[position]
+                if not key.startswith(query):
+                    break
+                found.setdefault(ingredient_id, rows[ingredient_id])
+                position += 1
+        return list(found.values())
+
+
+ingredient_catalog = IngredientCatalog(
+    Ingredient, ('id', 'name', 'measurement_unit'))
+tag_catalog = Catalog(Tag, ('id', 'name', 'color', 'slug'))
@@ -1,8 +1,17 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank
 from django.core.exceptions import ValidationError
+from django.db.models import Case, Exists, F, OuterRef, Q, Value, When
+from django.db.models.lookups import Contains
 import django_filters as filters
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.settings import api_settings
 
 from users.models import User
-from recipes.models import Ingredient, Recipe
+from recipes.models import (FavoriteRecipe, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCart)
+from recipes.search import SEARCH_CONFIG, UnicodeLower, is_supported
+
+from .catalog import tag_catalog
 
 
 class TagsMultipleChoiceField(
@@ -24,6 +33,12 @@ class TagsFilter(filters.AllValuesMultipleFilter):
     field_class = TagsMultipleChoiceField
 
 
+def tag_choices():
+    """Варианты ?tags= из справочника тегов в памяти, без запроса к БД."""
+
+    return [(tag['slug'], tag['name']) for tag in tag_catalog.get().values()]
+
+
 class IngredientFilter(filters.FilterSet):
     name = filters.CharFilter(lookup_expr='istartswith')
 
@@ -37,14 +52,83 @@ class RecipeFilter(filters.FilterSet):
         queryset=User.objects.all())
     is_in_shopping_cart = filters.BooleanFilter(
         widget=filters.widgets.BooleanWidget(),
+        method='filter_is_in_shopping_cart',
         label='В корзине.')
     is_favorited = filters.BooleanFilter(
         widget=filters.widgets.BooleanWidget(),
+        method='filter_is_favorited',
         label='В избранном.')
-    tags = filters.AllValuesMultipleFilter(
-        field_name='tags__slug',
+    tags = filters.MultipleChoiceFilter(
+        choices=tag_choices,
+        method='filter_tags',
         label='Ссылка')
 
     class Meta:
         model = Recipe
         fields = ['is_favorited', 'is_in_shopping_cart', 'author', 'tags']
+
+    def filter_collection(self, queryset, collection, value):
+        """Полусоединение от строк пользователя в избранном или корзине:
+        БД читает только их, а не проверяет каждый рецепт."""
+
+        user = self.request.user
+        if not user.is_authenticated:
+            return queryset.none() if value else queryset
+        recipe_ids = collection.recipe.through.objects.filter(**{
+            f'{collection._meta.model_name}__user': user}).values(
+                'recipe_id')
+        if value:
+            return queryset.filter(id__in=recipe_ids)
+        return queryset.exclude(id__in=recipe_ids)
+
+    def filter_is_favorited(self, queryset, name, value):
+        return self.filter_collection(queryset, FavoriteRecipe, value)
+
+    def filter_is_in_shopping_cart(self, queryset, name, value):
+        return self.filter_collection(queryset, ShoppingCart, value)
+
+    def filter_tags(self, queryset, name, value):
+        """EXISTS по связям с тегами: рецепт с несколькими тегами
+        не размножается, DISTINCT не нужен."""
+
+        if not value:
+            return queryset
+        tag_ids = [
+            tag['id'] for tag in tag_catalog.get().values()
+            if tag['slug'] in value]
+        return queryset.filter(Exists(Recipe.tags.through.objects.filter(
+            recipe_id=OuterRef('id'), tag_id__in=tag_ids)))
+
+
+class RecipeSearchFilter(BaseFilterBackend):
+    """Поиск рецептов по названию, описанию и ингредиентам: ?search=.
+
+    В PostgreSQL — по search_vector с GIN-индексом и ранжированием,
+    в остальных БД — вхождение без учета регистра (и для кириллицы),
+    название выше описания и ингредиентов."""
+
+    search_param = api_settings.SEARCH_PARAM
+
+    def filter_queryset(self, request, queryset, view):
+        term = request.query_params.get(self.search_param, '').strip()
+        if not term:
+            return queryset
+        if is_supported():
+            query = SearchQuery(
+                term, config=SEARCH_CONFIG, search_type='websearch')
+            return queryset.filter(search_vector=query).annotate(
+                search_rank=SearchRank(F('search_vector'), query)
+            ).order_by('-search_rank', '-pub_date', '-id')
+        term = term.lower()
+        by_name = Contains(UnicodeLower('name'), term)
+        by_text = Contains(UnicodeLower('text'), term)
+        by_ingredient = Exists(RecipeIngredient.objects.filter(
+            Contains(UnicodeLower('ingredient__name'), term),
+            recipe=OuterRef('id')))
+        return queryset.filter(
+            Q(by_name) | Q(by_text) | Q(by_ingredient)
+        ).annotate(search_rank=Case(
+            When(by_name, then=Value(3)),
+            When(by_text, then=Value(2)),
+            default=Value(1))
+        ).order_by('-search_rank', '-pub_date', '-id')
@@ -0,0 +1,73 @@
+from time import perf_counter, process_time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from api.renderers import ORJSONRenderer
+from api.serializers import RecipeReadSerializer, RecipeRowsSerializer
+from api.views import RecipesViewSet
+
+User = get_user_model()
+ORDERING = ('-pub_date', '-id')
+
+
+class Command(BaseCommand):
+    help = ('Замер списка рецептов: ModelSerializer + json '
+            'против values() + orjson, с проверкой одинаковых байт')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[6, 50])
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--email', help='Читать от имени пользователя')
+
+    def get_view(self, email):
+        request = Request(APIRequestFactory().get('/api/recipes/'))
+        request.user = AnonymousUser()
+        if email:
+            request.user = User.objects.filter(email=email).first()
+            if request.user is None:
+                raise CommandError(f'Нет пользователя {email}')
+        view = RecipesViewSet(
+            request=request, format_kwarg=None, action='list', kwargs={})
+        return view
+
+    def render_models(self, view, size):
+        recipes = view.get_queryset().order_by(*ORDERING)[:size]
+        data = RecipeReadSerializer(
+            recipes, many=True, context=view.get_serializer_context()).data
+        return JSONRenderer().render(data)
+
+    def render_rows(self, view, size):
+        rows = view.get_rows_queryset().order_by(*ORDERING)[:size]
+        data = RecipeRowsSerializer(
+            rows, context=view.get_serializer_context()).data
+        return ORJSONRenderer().render(data)
+
+    def measure(self, render, view, size, repeat):
+        wall = cpu = 0
+        for _ in range(repeat):
+            started, started_cpu = perf_counter(), process_time()
+            render(view, size)
+            wall += perf_counter() - started
+            cpu += process_time() - started_cpu
+        return wall / repeat * 1000, cpu / repeat * 1000
+
+    def handle(self, *args, **options):
+        view = self.get_view(options['email'])
+        repeat = options['repeat']
+        for size in options['sizes']:
+            if self.render_models(view, size) != self.render_rows(view, size):
+                raise CommandError(f'{size} рецептов: ответы различаются')
+            models_wall, models_cpu = self.measure(
+                self.render_models, view, size, repeat)
+            rows_wall, rows_cpu = self.measure(
+                self.render_rows, view, size, repeat)
+            self.stdout.write(
+                f'{size:>5} рецептов: '
+                f'models {models_wall:.2f} мс (cpu {models_cpu:.2f}), '
+                f'rows {rows_wall:.2f} мс (cpu {rows_cpu:.2f}), '
+                f'cpu x{models_cpu / max(rows_cpu, 1e-9):.1f}')
@@ -0,0 +1,35 @@
+from time import perf_counter
+
+from django.core.management import BaseCommand
+
+from api.shopping_list import register_font, render_cache, render_pdf
+
+
+class Command(BaseCommand):
+    help = 'Замер рендера списка покупок: холодный и из кэша'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', nargs='+', type=int, default=[10, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        register_font()
+        repeat = options['repeat']
+        for size in options['sizes']:
+            rows = [
+                (f'ингредиент {index}', 'г', index)
+                for index in range(size)]
+            cold = warm = 0
+            for _ in range(repeat):
+                render_cache.clear()
+                started = perf_counter()
+                render_pdf(rows)
+                cold += perf_counter() - started
+                started = perf_counter()
+                render_pdf(rows)
+                warm += perf_counter() - started
+            self.stdout.write(
+                f'{size:>5} строк: '
+                f'cold {cold / repeat * 1000:.2f} мс, '
+                f'warm {warm / repeat * 1000:.2f} мс')
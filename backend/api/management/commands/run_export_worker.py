@@ -0,0 +1,101 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api.shopping_list import render_export
+from recipes.management.worker import WorkerCommand
+from recipes.models import ExportJob
+
+User = get_user_model()
+ATTEMPTS_ERROR = 'Выгрузка не завершилась за отведенные попытки.'
+
+
+class Command(WorkerCommand):
+    help = 'Обработчик фоновых выгрузок списка покупок'
+    done_message = 'Обработано выгрузок: {}'
+
+    def claim(self):
+        """Берем задачу из очереди, не больше одной на пользователя.
+
+        Зависшие задачи (воркер упал) возвращаются в работу по таймауту,
+        исчерпавшие попытки остаются с ошибкой."""
+
+        now = timezone.now()
+        stale = Q(
+            status=ExportJob.RUNNING,
+            started__lt=now - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT))
+        ExportJob.objects.filter(
+            stale, attempts__gte=settings.EXPORT_JOB_ATTEMPTS
+        ).update(status=ExportJob.FAILED, error=ATTEMPTS_ERROR, finished=now)
+        busy_users = []
+        while True:
+            # Транзакция на кандидата: блокируем задачу, затем
+            # пользователя, так что воркеры не ждут друг друга по кругу.
+            with transaction.atomic():
+                job = ExportJob.objects.select_for_update(
+                    skip_locked=True
+                ).filter(
+                    Q(status=ExportJob.PENDING) | stale
+                ).exclude(
+                    user_id__in=busy_users
+                ).order_by('id').first()
+                if job is None:
+                    return None
+                # Пока держим строку пользователя, другой воркер не возьмет
+                # его задачу, а после нас увидит эту уже в работе.
+                User.objects.select_for_update().filter(
+                    id=job.user_id).values_list('id').get()
+                if ExportJob.objects.filter(
+                        user_id=job.user_id, status=ExportJob.RUNNING
+                ).exclude(stale).exclude(id=job.id).exists():
+                    busy_users.append(job.user_id)
+                    continue
+                job.status = ExportJob.RUNNING
+                job.started = now
+                job.attempts += 1
+                job.save(update_fields=('status', 'started', 'attempts'))
+                return job
+
+    def process(self, job):
+        try:
+            content = render_export(job.user, job.export_format)
+        except Exception as error:
+            job.status = ExportJob.FAILED
+            job.error = str(error)
+        else:
+            job.file.save(
+                f'{job.user_id}-{job.id}.{job.export_format}',
+                ContentFile(content), save=False)
+            job.status = ExportJob.DONE
+        job.finished = timezone.now()
+        job.save(update_fields=('status', 'file', 'error', 'finished'))
+
+    def cleanup(self):
+        """Удаляем старые выгрузки вместе с файлами."""
+
+        expired = ExportJob.objects.filter(
+            finished__lt=timezone.now() - timedelta(
+                seconds=settings.EXPORT_JOB_TTL))
+        for job in expired.iterator():
+            if job.file:
+                job.file.delete(save=False)
+            job.delete()
+
+    def process_batch(self):
+        job = self.claim()
+        if job is None:
+            return 0
+        self.process(job)
+        return 1
+
+    def idle(self):
+        self.cleanup()
+
+    def handle(self, *args, **options):
+        self.cleanup()
+        super().handle(*args, **options)
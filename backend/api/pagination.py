@@ -1,6 +1,49 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+MAX_PAGE_SIZE = 100
 
 
 class LimitPageNumberPagination(PageNumberPagination):
     page_size = 6
     page_size_query_param = 'limit'
+    max_page_size = MAX_PAGE_SIZE
+
+
+class LimitCursorPagination(CursorPagination):
+    """Курсор по (pub_date, id): без COUNT(*) и OFFSET."""
+
+    page_size = 6
+    page_size_query_param = 'limit'
+    max_page_size = MAX_PAGE_SIZE
+    ordering = ('-pub_date', '-id')
+
+    def get_ordering(self, request, queryset, view):
+        return getattr(view, 'cursor_ordering', self.ordering)
+
+
+class FeedPagination(LimitPageNumberPagination):
+    """Курсорная пагинация при ?cursor=, иначе постраничная.
+
+    Результаты поиска (?search=) идут по релевантности, а курсор — по
+    (pub_date, id), поэтому они всегда постраничные: ?cursor= с ?search=
+    не меняет порядок, а отдает страницы с номерами."""
+
+    cursor_query_param = LimitCursorPagination.cursor_query_param
+
+    @staticmethod
+    def is_ranked(queryset):
+        return 'search_rank' in queryset.query.annotations
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = None
+        if (self.cursor_query_param in request.query_params
+                and not self.is_ranked(queryset)):
+            self.cursor_paginator = LimitCursorPagination()
+            return self.cursor_paginator.paginate_queryset(
+                queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
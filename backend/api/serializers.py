@@ -1,14 +1,30 @@
+from uuid import uuid4
+
 import django.contrib.auth.password_validation as validators
 from django.contrib.auth import authenticate, get_user_model
 from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import (Exists, OuterRef, Prefetch, Value,
+                              prefetch_related_objects)
 from drf_base64.fields import Base64ImageField
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 from rest_framework.exceptions import ValidationError
 
-from recipes.models import Ingredient, Recipe, RecipeIngredient, Subscribe, Tag
+from recipes.images import DATA_URI, ImageError, verify_image
+from recipes.search import update_search_vectors
+from recipes.models import (ExportJob, Ingredient, Recipe, RecipeIngredient,
+                            ShoppingListItem, Subscribe, Tag,
+                            ingredients_changed)
+
+from .catalog import ingredient_catalog, tag_catalog
 
 User = get_user_model()
+RECIPE_HIDDEN_FIELDS = (
+    'favorites_count', 'in_carts_count', 'image_source', 'image_status',
+    'image_claimed', 'image_attempts', 'search_vector')
 ERROR_MSG = 'Не удается войти в систему с предоставленными учетными данными.'
 
 
@@ -52,10 +68,35 @@ class GetIsSubscribedMixin:
         user = self.context['request'].user
         if not user.is_authenticated:
             return False
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         return user.follower.filter(author=obj).exists()
 
 
+class SparseFieldsMixin:
+    """Прореживаем поля по context['sparse_fields'] и context['expand'].
+
+    collapsed_fields — как отдать вложенный объект, если его не раскрыли."""
+
+    collapsed_fields = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        only = self.context.get('sparse_fields')
+        if only is not None:
+            fields = {
+                name: field for name, field in fields.items()
+                if name in only}
+        expand = self.context.get('expand')
+        if expand is not None:
+            for name, collapsed in self.collapsed_fields.items():
+                if name in fields and name not in expand:
+                    fields[name] = collapsed()
+        return fields
+
+
 class UserListSerializer(
+        SparseFieldsMixin,
         GetIsSubscribedMixin,
         serializers.ModelSerializer):
     is_subscribed = serializers.BooleanField(read_only=True)
@@ -146,6 +187,15 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
             'id', 'name', 'measurement_unit', 'amount')
 
 
+class RecipeIngredientAmountSerializer(serializers.ModelSerializer):
+    id = serializers.ReadOnlyField(
+        source='ingredient_id')
+
+    class Meta:
+        model = RecipeIngredient
+        fields = ('id', 'amount')
+
+
 class RecipeUserSerializer(
         GetIsSubscribedMixin,
         serializers.ModelSerializer):
@@ -177,13 +227,27 @@ class IngredientsEditSerializer(serializers.ModelSerializer):
         return data
 
 
+class DeferredImageField(serializers.CharField):
+    """Картинка в base64. В запросе декодируем и проверяем, что это
+    изображение, и сохраняем исходник: на варианты режет run_image_worker."""
+
+    def to_internal_value(self, data):
+        data = super().to_internal_value(data)
+        if not DATA_URI.match(data):
+            raise ValidationError('Ожидается изображение в base64.')
+        try:
+            raw, extension = verify_image(data.encode())
+        except ImageError as error:
+            raise ValidationError(str(error)) from error
+        return ContentFile(raw, name=f'{uuid4().hex}.{extension}')
+
+
 class RecipeWriteSerializer(serializers.ModelSerializer):
-    image = Base64ImageField(
-        max_length=None,
-        use_url=True)
-    tags = serializers.PrimaryKeyRelatedField(
-        many=True,
-        queryset=Tag.objects.all())
+    image = DeferredImageField(
+        source='image_source',
+        write_only=True)
+    tags = serializers.ListField(
+        child=serializers.IntegerField())
     ingredients = IngredientsEditSerializer(
         many=True)
     author = UserListSerializer(read_only=True)
@@ -191,92 +255,146 @@ class RecipeWriteSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Recipe
-        fields = '__all__'
+        exclude = RECIPE_HIDDEN_FIELDS + ('images',)
         read_only_fields = ('author',)
     
-    def validate_ingredients(self, data):
-        """Валидатор для ингредиентов"""
-        ingredients = self.initial_data.get('ingredients')
-        list = []
-        for i in ingredients:
-            if i['id'] in list:
-                raise serializers.ValidationError({
-                    'ingredient': 'Ингредиент должны быть уникальными!'
-                })
-            list.append(i['id'])
-        return data
-    
-    def validate_time_tag(self, validated_data):
-        tags = validated_data.get('tags')
-        if not tags:
-            raise serializers.ValidationError({
-                'tags': 'Не задан tag.'
-            })
-        tags_list = []
-        for tag in tags:
-            if tag in tags_list:
-                raise serializers.ValidationError({
-                    'tags': 'Такой tag уже существует.'
-                })
-            tags_list.append(tag)
-
-        cooking_time = validated_data.get('cooking_time')
-        if int(cooking_time) <= 0:
-            raise serializers.ValidationError({
-                'cooking_time': 'Время не может быть нулевым.'
-            })
-        return validated_data
-    
-    def create_ingredients(self, ingredients, recipe):
-        """Метод создания ингредиента."""
+    def validate_ingredients(self, ingredients):
+        """Ингредиенты есть в справочнике и не повторяются."""
 
+        catalog = ingredient_catalog.get()
+        seen = set()
+        errors = []
         for ingredient in ingredients:
-            RecipeIngredient.objects.create(
-                recipe=recipe,
-                ingredient_id=ingredient.get("id"),
-                amount=ingredient.get("amount"),
-            )
+            ingredient_id = ingredient['id']
+            if ingredient_id not in catalog:
+                errors.append(
+                    {'id': [f'Ингредиента с id={ingredient_id} нет.']})
+            elif ingredient_id in seen:
+                errors.append(
+                    {'id': ['Ингредиенты должны быть уникальными!']})
+            else:
+                errors.append({})
+            seen.add(ingredient_id)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return ingredients
+
+    def validate_tags(self, tags):
+        """Теги есть в справочнике и не повторяются."""
 
-    def create_tags(self, tags, recipe):
-        """Метод создания тега."""
+        if not tags:
+            raise serializers.ValidationError('Не задан tag.')
+        catalog = tag_catalog.get()
+        seen = set()
+        errors = {}
+        for index, tag_id in enumerate(tags):
+            if tag_id not in catalog:
+                errors[index] = [f'Тега с id={tag_id} нет.']
+            elif tag_id in seen:
+                errors[index] = ['Такой tag уже существует.']
+            seen.add(tag_id)
+        if errors:
+            raise serializers.ValidationError(errors)
+        return tags
 
-        for tag in tags:
-            recipe.tags.add(tag)
+    def create_ingredients(self, ingredients, recipe):
+        """Метод создания ингредиентов одним запросом."""
 
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(
+                recipe=recipe,
+                ingredient_id=ingredient['id'],
+                amount=ingredient['amount'])
+            for ingredient in ingredients)
+
+    def update_ingredients(self, ingredients, recipe):
+        """Меняем только разницу: новые, измененные и удаленные."""
+
+        current = {
+            row.ingredient_id: row for row in recipe.recipe.only(
+                'id', 'recipe_id', 'ingredient_id', 'amount')}
+        old_amounts = {
+            ingredient_id: row.amount
+            for ingredient_id, row in current.items()}
+        amounts = {
+            ingredient['id']: ingredient['amount']
+            for ingredient in ingredients}
+        removed = [
+            row.id for ingredient_id, row in current.items()
+            if ingredient_id not in amounts]
+        if removed:
+            RecipeIngredient.objects.filter(id__in=removed).delete()
+        changed = []
+        for ingredient_id, row in current.items():
+            amount = amounts.get(ingredient_id)
+            if amount is not None and amount != row.amount:
+                row.amount = amount
+                changed.append(row)
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ('amount',))
+        self.create_ingredients(
+            [ingredient for ingredient in ingredients
+             if ingredient['id'] not in current], recipe)
+        return old_amounts
+
+    @transaction.atomic
     def create(self, validated_data):
         """Метод создания рецепта."""
 
         author = validated_data.pop('author')
         tags = validated_data.pop('tags')
         ingredients = validated_data.pop('ingredients')
-        recipe = Recipe.objects.create(author=author, **validated_data)
-        self.create_tags(tags, recipe)
+        recipe = Recipe.objects.create(
+            author=author, image_status=Recipe.IMAGE_PENDING,
+            **validated_data)
+        recipe.tags.add(*tags)
         self.create_ingredients(ingredients, recipe)
+        ingredients_changed([recipe.id])
         return recipe
 
     def to_representation(self, instance):
         """Метод прудставления рецептов по Get запросу. На чтение."""
 
+        prefetch_related_objects(
+            [instance], 'tags', Prefetch(
+                'recipe',
+                queryset=RecipeIngredient.objects.select_related(
+                    'ingredient')))
         request = self.context.get('request')
         context = {'request': request}
         return RecipeReadSerializer(
             instance, context=context).data
 
+    @transaction.atomic
     def update(self, recipe, validated_data):
         """Метод обновления рецепта."""
 
+        ingredients = None
         if "ingredients" in self.initial_data:
             ingredients = validated_data.pop("ingredients")
-            recipe.ingredients.clear()
-            self.create_ingredients(ingredients, recipe)
+            old_amounts = self.update_ingredients(ingredients, recipe)
+            ShoppingListItem.objects.change_recipe(
+                recipe, old_amounts,
+                {item['id']: item['amount'] for item in ingredients})
         if "tags" in self.initial_data:
             tags_data = validated_data.pop("tags")
             recipe.tags.set(tags_data)
-        return super().update(recipe, validated_data)
+        if 'image_source' in validated_data:
+            validated_data['image_status'] = Recipe.IMAGE_PENDING
+            validated_data['image_attempts'] = 0
+        recipe = super().update(recipe, validated_data)
+        if ingredients is not None:
+            ingredients_changed([recipe.id])
+        elif {'name', 'text'} & validated_data.keys():
+            update_search_vectors([recipe.id])
+        return recipe
 
 
-class RecipeReadSerializer(serializers.ModelSerializer):
+class RecipeReadSerializer(
+        SparseFieldsMixin,
+        serializers.ModelSerializer):
     image = Base64ImageField()
+    images = serializers.SerializerMethodField()
     tags = TagSerializer(
         many=True,
         read_only=True)
@@ -292,9 +410,112 @@ class RecipeReadSerializer(serializers.ModelSerializer):
     is_in_shopping_cart = serializers.BooleanField(
         read_only=True)
 
+    collapsed_fields = {
+        'author': lambda: serializers.ReadOnlyField(source='author_id'),
+        'tags': lambda: serializers.PrimaryKeyRelatedField(
+            many=True, read_only=True),
+        'ingredients': lambda: RecipeIngredientAmountSerializer(
+            many=True, read_only=True, source='recipe'),
+    }
+
     class Meta:
         model = Recipe
-        fields = '__all__'
+        exclude = RECIPE_HIDDEN_FIELDS
+
+    def get_images(self, obj):
+        """Варианты картинки: {вариант: {формат: url}}."""
+
+        request = self.context.get('request')
+        return {
+            variant: {
+                extension: request.build_absolute_uri(
+                    default_storage.url(name))
+                for extension, name in files.items()}
+            for variant, files in obj.images.items()}
+
+
+class RecipeRowsSerializer:
+    """Быстрое чтение списка рецептов из строк values().
+
+    Отдает то же, что RecipeReadSerializer, но без экземпляров моделей:
+    теги, ингредиенты и авторы страницы берутся тремя запросами и
+    раскладываются по словарям."""
+
+    columns = (
+        'id', 'image', 'images', 'author_id', 'name', 'text',
+        'cooking_time', 'pub_date', 'is_favorited', 'is_in_shopping_cart')
+    pub_date_field = serializers.DateTimeField()
+
+    def __init__(self, rows, context):
+        self.rows = list(rows)
+        self.request = context['request']
+
+    def build_url(self, name):
+        if not name:
+            return None
+        return self.request.build_absolute_uri(default_storage.url(name))
+
+    def get_tags(self, recipe_ids):
+        tags = {}
+        for recipe_id, *tag in Recipe.tags.through.objects.filter(
+                recipe_id__in=recipe_ids
+        ).order_by('-tag_id').values_list(
+                'recipe_id', 'tag_id', 'tag__name', 'tag__color',
+                'tag__slug'):
+            tags.setdefault(recipe_id, []).append(
+                dict(zip(('id', 'name', 'color', 'slug'), tag)))
+        return tags
+
+    def get_ingredients(self, recipe_ids):
+        ingredients = {}
+        for recipe_id, *ingredient in RecipeIngredient.objects.filter(
+                recipe_id__in=recipe_ids
+        ).order_by('-id').values_list(
+                'recipe_id', 'ingredient_id', 'ingredient__name',
+                'ingredient__measurement_unit', 'amount'):
+            ingredients.setdefault(recipe_id, []).append(dict(zip(
+                ('id', 'name', 'measurement_unit', 'amount'), ingredient)))
+        return ingredients
+
+    def get_authors(self, author_ids):
+        user = self.request.user
+        authors = User.objects.filter(id__in=author_ids)
+        if user.is_authenticated:
+            authors = authors.annotate(is_subscribed=Exists(
+                user.follower.filter(author=OuterRef('id'))))
+        else:
+            authors = authors.annotate(is_subscribed=Value(False))
+        return {
+            author['id']: author for author in authors.values(
+                'email', 'id', 'username', 'first_name', 'last_name',
+                'is_subscribed')}
+
+    @property
+    def data(self):
+        recipe_ids = [row['id'] for row in self.rows]
+        tags = self.get_tags(recipe_ids)
+        ingredients = self.get_ingredients(recipe_ids)
+        authors = self.get_authors({row['author_id'] for row in self.rows})
+        build_url = self.build_url
+        return [{
+            'id': row['id'],
+            'image': build_url(row['image']),
+            'images': {
+                variant: {
+                    extension: build_url(name)
+                    for extension, name in files.items()}
+                for variant, files in row['images'].items()},
+            'tags': tags.get(row['id'], []),
+            'author': authors[row['author_id']],
+            'ingredients': ingredients.get(row['id'], []),
+            'is_favorited': bool(row['is_favorited']),
+            'is_in_shopping_cart': bool(row['is_in_shopping_cart']),
+            'name': row['name'],
+            'text': row['text'],
+            'cooking_time': row['cooking_time'],
+            'pub_date': self.pub_date_field.to_representation(
+                row['pub_date']),
+        } for row in self.rows]
 
 
 class SubscribeRecipeSerializer(serializers.ModelSerializer):
@@ -304,6 +525,18 @@ class SubscribeRecipeSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'image', 'cooking_time')
 
 
+class SubscribeListSerializer(serializers.ListSerializer):
+    """Рецепты всех авторов страницы одним запросом."""
+
+    def to_representation(self, data):
+        subscriptions = list(data)
+        self.context['author_recipes'] = Recipe.objects.latest_by_author(
+            {subscription.author_id for subscription in subscriptions},
+            self.child.get_recipes_limit(),
+            SubscribeRecipeSerializer.Meta.fields)
+        return super().to_representation(subscriptions)
+
+
 class SubscribeSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(
         source='author.id')
@@ -319,6 +552,7 @@ class SubscribeSerializer(serializers.ModelSerializer):
     is_subscribed = serializers.BooleanField(
         read_only=True)
     recipes_count = serializers.IntegerField(
+        source='author.recipes_count',
         read_only=True)
 
     class Meta:
@@ -326,13 +560,32 @@ class SubscribeSerializer(serializers.ModelSerializer):
         fields = (
             'email', 'id', 'username', 'first_name', 'last_name',
             'is_subscribed', 'recipes', 'recipes_count',)
-    
+        list_serializer_class = SubscribeListSerializer
+
+    def get_recipes_limit(self):
+        limit = self.context['request'].GET.get('recipes_limit', '')
+        return int(limit) if limit.isdigit() else None
+
     def get_recipes(self, obj):
-        request = self.context.get('request')
-        limit = request.GET.get('recipes_limit')
-        recipes = (
-            obj.author.recipe.all()[:int(limit)] if limit
-            else obj.author.recipe.all())
+        author_recipes = self.context.get('author_recipes')
+        if author_recipes is None:
+            author_recipes = Recipe.objects.latest_by_author(
+                [obj.author_id], self.get_recipes_limit(),
+                SubscribeRecipeSerializer.Meta.fields)
+        recipes = author_recipes.get(obj.author_id, [])
         return SubscribeRecipeSerializer(
             recipes,
             many=True).data
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    format = serializers.ChoiceField(
+        source='export_format',
+        choices=ExportJob.FORMAT_CHOICES,
+        default='pdf')
+
+    class Meta:
+        model = ExportJob
+        fields = (
+            'id', 'format', 'status', 'error', 'created', 'finished')
+        read_only_fields = ('status', 'error', 'created', 'finished')
@@ -0,0 +1,196 @@
+import csv
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from reportlab.pdfbase import pdfmetrics, ttfonts
+from reportlab.pdfgen import canvas
+
+FONT_NAME = 'Arial'
+
+_font_lock = threading.Lock()
+_font_registered = False
+
+
+def register_font():
+    """Регистрируем шрифт один раз на процесс."""
+
+    global _font_registered
+    if _font_registered:
+        return
+    with _font_lock:
+        if not _font_registered:
+            pdfmetrics.registerFont(
+                ttfonts.TTFont(FONT_NAME, settings.FONT_PATH))
+            _font_registered = True
+
+
+class RenderCache:
+    """LRU-кэш готовых PDF, ограниченный по суммарному размеру."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            content = self._items.get(key)
+            if content is not None:
+                self._items.move_to_end(key)
+            return content
+
+    def set(self, key, content):
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+render_cache = RenderCache(settings.SHOPPING_LIST_CACHE_BYTES)
+
+
+def shopping_list_rows(user):
+    """Список покупок: кортежи (ингредиент, единица, количество)."""
+
+    return user.shopping_list.values_list(
+        'ingredient__name',
+        'ingredient__measurement_unit',
+        'total_amount'
+    ).order_by('ingredient__name', 'ingredient__measurement_unit')
+
+
+def rows_digest(rows):
+    """Хэш содержимого списка покупок, ключ кэша."""
+
+    digest = hashlib.sha256()
+    for name, unit, amount in rows:
+        digest.update(f'{name}\x1f{unit}\x1f{amount}\x1e'.encode())
+    return digest.hexdigest()
+
+
+def draw_pdf(rows):
+    """Рисуем PDF со списком покупок."""
+
+    register_font()
+    buffer = io.BytesIO()
+    page = canvas.Canvas(buffer)
+    x_position, y_position = 50, 800
+    if not rows:
+        page.setFont(FONT_NAME, 24)
+        page.drawString(x_position, y_position, 'Cписок покупок пуст!')
+        page.save()
+        return buffer.getvalue()
+    page.setFont(FONT_NAME, 14)
+    indent = 20
+    page.drawString(x_position, y_position, 'Cписок покупок:')
+    for index, (name, unit, amount) in enumerate(rows, start=1):
+        page.drawString(
+            x_position, y_position - indent,
+            f'{index}. {name} - {amount} {unit}.')
+        y_position -= 15
+        if y_position <= 50:
+            page.showPage()
+            page.setFont(FONT_NAME, 14)
+            y_position = 800
+    page.save()
+    return buffer.getvalue()
+
+
+def render_pdf(rows):
+    """PDF из кэша, при промахе рисуем и кладем в кэш."""
+
+    rows = list(rows)
+    key = rows_digest(rows)
+    content = render_cache.get(key)
+    if content is None:
+        content = draw_pdf(rows)
+        render_cache.set(key, content)
+    return content
+
+
+class Echo:
+    """Псевдо-файл для csv.writer: строку отдаем сразу, не копим."""
+
+    def write(self, value):
+        return value
+
+
+def stream_txt(rows):
+    yield 'Cписок покупок:\n'
+    for index, (name, unit, amount) in enumerate(rows, start=1):
+        yield f'{index}. {name} - {amount} {unit}.\n'
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('name', 'measurement_unit', 'amount'))
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_json(rows):
+    separator = '['
+    for name, unit, amount in rows:
+        yield separator + json.dumps(
+            {'name': name, 'measurement_unit': unit, 'amount': amount},
+            ensure_ascii=False)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+def stream_pdf(rows):
+    # reportlab пишет документ целиком только в Canvas.save(),
+    # поэтому PDF отдаем одним куском из кэша.
+    yield render_pdf(rows)
+
+
+EXPORT_FORMATS = {
+    'pdf': ('application/pdf', stream_pdf),
+    'txt': ('text/plain; charset=utf-8', stream_txt),
+    'csv': ('text/csv; charset=utf-8', stream_csv),
+    'json': ('application/json', stream_json),
+}
+
+
+def export_rows(user, export_format):
+    """Строки списка покупок в порядке выгрузки.
+
+    Для потоковых форматов читаем запрос через iterator(),
+    без кэша результатов в QuerySet."""
+
+    rows = shopping_list_rows(user)
+    if export_format == 'pdf':
+        return rows
+    return rows.iterator(chunk_size=settings.SHOPPING_LIST_CHUNK_SIZE)
+
+
+def stream_export(user, export_format):
+    """Генератор содержимого выгрузки в нужном формате."""
+
+    _, stream = EXPORT_FORMATS[export_format]
+    return stream(export_rows(user, export_format))
+
+
+def render_export(user, export_format):
+    """Выгрузка целиком в байтах, для фоновых задач."""
+
+    return b''.join(
+        chunk if isinstance(chunk, bytes) else chunk.encode()
+        for chunk in stream_export(user, export_format))
@@ -0,0 +1,60 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from api.cache import bump_user_state, bump_version
+from recipes.models import (FavoriteRecipe, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCart, Subscribe, Tag)
+
+User = get_user_model()
+
+
+def bump_after_commit(model):
+    def receiver(sender, **kwargs):
+        transaction.on_commit(lambda: bump_version(model))
+    return receiver
+
+
+# Ответы зависят от таблицы model, а меняют ее записи senders.
+VERSIONED = {
+    Recipe: (Recipe, RecipeIngredient, Recipe.tags.through),
+    Tag: (Tag,),
+    Ingredient: (Ingredient,),
+    User: (User,),
+}
+
+
+def bump_collection_owner(sender, instance, action, **kwargs):
+    if action.startswith('post_') and hasattr(instance, 'user_id'):
+        user_id = instance.user_id
+        transaction.on_commit(lambda: bump_user_state(user_id))
+
+
+def bump_subscriber(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: bump_user_state(user_id))
+
+
+def connect():
+    for model, senders in VERSIONED.items():
+        receiver = bump_after_commit(model)
+        for sender in senders:
+            if sender._meta.auto_created:
+                m2m_changed.connect(
+                    receiver, sender=sender, weak=False,
+                    dispatch_uid=f'version:{model._meta.label}:m2m')
+                continue
+            for signal in (post_save, post_delete):
+                signal.connect(
+                    receiver, sender=sender, weak=False,
+                    dispatch_uid=(
+                        f'version:{model._meta.label}:{sender._meta.label}'))
+    for sender in (FavoriteRecipe.recipe.through,
+                   ShoppingCart.recipe.through):
+        m2m_changed.connect(
+            bump_collection_owner, sender=sender,
+            dispatch_uid=f'user-state:{sender._meta.label}')
+    for signal in (post_save, post_delete):
+        signal.connect(
+            bump_subscriber, sender=Subscribe,
+            dispatch_uid='user-state:subscribe')
@@ -0,0 +1,542 @@
+import base64
+import io
+import json
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock, skipIf, skipUnless
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient, APIRequestFactory
+
+from api.catalog import ingredient_catalog
+from api.filters import RecipeFilter
+from api.management.commands.run_export_worker import (
+    Command as ExportWorker)
+
+from recipes.models import (DirtyRecipe, ExportJob, Ingredient, Recipe,
+                            RecipeActivity, RecipeIngredient,
+                            ShoppingListItem, Subscribe, Tag)
+from recipes.search import update_search_vectors
+from users.models import User
+
+RECIPES_COUNT = 12
+
+
+def create_user(email):
+    return User.objects.create_user(
+        email=email, username=email.split('@')[0],
+        first_name='Имя', last_name='Фамилия', password='password')
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child)
+
+
+class RecipesTestCase(TestCase):
+    """Общие данные: два автора, рецепты с тегами и ингредиентами."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author@example.com')
+        cls.user = create_user('user@example.com')
+        cls.tags = [
+            Tag.objects.create(name='Завтрак', color='#E26C2D',
+                               slug='breakfast'),
+            Tag.objects.create(name='Обед', color='#49B64E', slug='dinner')]
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {index}',
+                                      measurement_unit='г')
+            for index in range(3)]
+        cls.recipes = []
+        for index in range(RECIPES_COUNT):
+            recipe = Recipe.objects.create(
+                author=cls.author, name=f'Рецепт {index}', text='Описание',
+                cooking_time=10, image='static/recipe/image.jpg')
+            recipe.tags.set(cls.tags)
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=100)
+                for ingredient in cls.ingredients)
+            cls.recipes.append(recipe)
+        Subscribe.objects.create(user=cls.user, author=cls.author)
+        cls.user.favorite_recipe.recipe.add(cls.recipes[0])
+        cls.user.shopping_cart.recipe.add(cls.recipes[1])
+
+    def setUp(self):
+        cache.clear()
+        self.anonymous = APIClient()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+
+class RecipeQueriesTest(RecipesTestCase):
+    """Число запросов к БД не зависит от размера страницы."""
+
+    LIST_QUERIES = 5
+    # Авторизованному автор рецепта приходит отдельным запросом
+    # с is_subscribed.
+    DETAIL_QUERIES_ANONYMOUS = 3
+    DETAIL_QUERIES_AUTHENTICATED = 4
+
+    def assert_list_queries(self, client, limit):
+        with self.assertNumQueries(self.LIST_QUERIES):
+            response = client.get('/api/recipes/', {'limit': limit})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), limit)
+
+    def test_list_anonymous(self):
+        for limit in (2, RECIPES_COUNT):
+            with self.subTest(limit=limit):
+                cache.clear()
+                self.assert_list_queries(self.anonymous, limit)
+
+    def test_list_authenticated(self):
+        for limit in (2, RECIPES_COUNT):
+            with self.subTest(limit=limit):
+                self.assert_list_queries(self.client, limit)
+
+    def test_detail_anonymous(self):
+        with self.assertNumQueries(self.DETAIL_QUERIES_ANONYMOUS):
+            response = self.anonymous.get(
+                f'/api/recipes/{self.recipes[0].id}/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail_authenticated(self):
+        with self.assertNumQueries(self.DETAIL_QUERIES_AUTHENTICATED):
+            response = self.client.get(f'/api/recipes/{self.recipes[0].id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['is_favorited'])
+        self.assertTrue(response.data['author']['is_subscribed'])
+
+
+class RecipeCollectionFilterTest(RecipesTestCase):
+    """?is_favorited= и ?is_in_shopping_cart=."""
+
+    def get_ids(self, client, params):
+        response = client.get(
+            '/api/recipes/', {'limit': RECIPES_COUNT, **params})
+        self.assertEqual(response.status_code, 200)
+        return {recipe['id'] for recipe in response.data['results']}
+
+    def test_filters(self):
+        all_ids = {recipe.id for recipe in self.recipes}
+        for name, recipe in (('is_favorited', self.recipes[0]),
+                             ('is_in_shopping_cart', self.recipes[1])):
+            with self.subTest(name=name):
+                self.assertEqual(
+                    self.get_ids(self.client, {name: 1}), {recipe.id})
+                self.assertEqual(
+                    self.get_ids(self.client, {name: 0}),
+                    all_ids - {recipe.id})
+                self.assertEqual(
+                    self.get_ids(self.anonymous, {name: 1}), set())
+                self.assertEqual(
+                    self.get_ids(self.anonymous, {name: 0}), all_ids)
+
+    @skipUnless(connection.vendor == 'postgresql', 'EXPLAIN для PostgreSQL')
+    def test_plan_starts_from_collection(self):
+        """План идет от строк пользователя в коллекции, а рецепты
+        достает по первичному ключу, не просматривая таблицу."""
+
+        Recipe.objects.bulk_create(
+            Recipe(author=self.author, name=f'Рецепт {index}', text='Текст',
+                   cooking_time=10, image='static/recipe/image.jpg')
+            for index in range(2000))
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        request = APIRequestFactory().get('/api/recipes/')
+        request.user = self.user
+        for name, collection in (('is_favorited', 'favoriterecipe'),
+                                 ('is_in_shopping_cart', 'shoppingcart')):
+            with self.subTest(name=name):
+                queryset = RecipeFilter(
+                    {name: '1'}, queryset=Recipe.objects.all(),
+                    request=request).qs
+                plan = json.loads(queryset.explain(format='json'))[0]['Plan']
+                first = plan
+                while first.get('Plans'):
+                    first = first['Plans'][0]
+                self.assertIn(first.get('Relation Name'), (
+                    f'recipes_{collection}', f'recipes_{collection}_recipe'))
+                for node in plan_nodes(plan):
+                    if node.get('Relation Name') == 'recipes_recipe':
+                        self.assertEqual(
+                            node.get('Index Name'), 'recipes_recipe_pkey')
+                        self.assertIn('Index Cond', node)
+
+
+class IngredientCatalogTest(RecipesTestCase):
+    """Подсказка ингредиентов из справочника в памяти."""
+
+    def search(self, name):
+        response = self.anonymous.get('/api/ingredients/', {'name': name})
+        self.assertEqual(response.status_code, 200)
+        return [ingredient['name'] for ingredient in response.data]
+
+    def test_search_after_change(self):
+        self.assertEqual(len(self.search('ингредиент')), 3)
+        held = ingredient_catalog.snapshot()
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.create(name='Ингредиент новый',
+                                      measurement_unit='г')
+            self.ingredients[0].delete()
+        self.assertEqual(len(self.search('ингредиент')), 3)
+        self.assertIn('Ингредиент новый', self.search('нов'))
+        # Срез, взятый до изменения, остается целым.
+        self.assertEqual(len(held.rows), 3)
+        self.assertEqual(len(held.names), 3)
+
+
+class RecipeSearchTest(RecipesTestCase):
+    """?search= по названию, описанию и ингредиентам."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.by_name = Recipe.objects.create(
+            author=cls.author, name='Суп дня', text='Описание',
+            cooking_time=10, image='static/recipe/image.jpg')
+        cls.by_text = Recipe.objects.create(
+            author=cls.author, name='Обед', text='Подавать как СУП.',
+            cooking_time=10, image='static/recipe/image.jpg')
+        cls.by_ingredient = Recipe.objects.create(
+            author=cls.author, name='Бульон', text='Описание',
+            cooking_time=10, image='static/recipe/image.jpg')
+        RecipeIngredient.objects.create(
+            recipe=cls.by_ingredient, amount=1,
+            ingredient=Ingredient.objects.create(
+                name='Суповой набор', measurement_unit='шт'))
+        update_search_vectors()
+
+    def search(self, term):
+        response = self.anonymous.get('/api/recipes/', {'search': term})
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_search_ignores_case(self):
+        for term in ('суп', 'СуП'):
+            with self.subTest(term=term):
+                cache.clear()
+                self.assertEqual(
+                    self.search(term)[:2],
+                    [self.by_name.id, self.by_text.id])
+
+    @skipIf(connection.vendor == 'postgresql', 'поиск без search_vector')
+    def test_fallback_matches_ingredients(self):
+        self.assertEqual(self.search('СУПОВОЙ'), [self.by_ingredient.id])
+        self.assertEqual(
+            self.search('суп'),
+            [self.by_name.id, self.by_text.id, self.by_ingredient.id])
+
+    @skipUnless(connection.vendor == 'postgresql', 'search_vector')
+    def test_full_text_search(self):
+        self.assertEqual(
+            self.search('супы'), [self.by_name.id, self.by_text.id])
+        self.assertEqual(
+            self.search('суповой набор'), [self.by_ingredient.id])
+        self.assertEqual(self.search('суп -обед'), [self.by_name.id])
+
+    def test_cursor_keeps_rank(self):
+        """С ?search= курсор не подменяет порядок по релевантности."""
+
+        response = self.anonymous.get(
+            '/api/recipes/', {'search': 'суп', 'cursor': '', 'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], len(self.search('суп')))
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [self.by_name.id])
+        self.assertIn('page=2', response.data['next'])
+
+
+class ExportWorkerClaimTest(RecipesTestCase):
+    """Очередь выгрузок: одна задача в работе на пользователя."""
+
+    def claim(self):
+        return ExportWorker().claim()
+
+    def test_one_running_job_per_user(self):
+        first = ExportJob.objects.create(user=self.user)
+        ExportJob.objects.create(user=self.user)
+        other = ExportJob.objects.create(user=self.author)
+        self.assertEqual(self.claim(), first)
+        self.assertEqual(self.claim(), other)
+        self.assertIsNone(self.claim())
+        first.refresh_from_db()
+        self.assertEqual(first.status, ExportJob.RUNNING)
+        self.assertEqual(first.attempts, 1)
+
+    def test_stale_job_is_retried_then_failed(self):
+        started = timezone.now() - timedelta(
+            seconds=settings.EXPORT_JOB_TIMEOUT + 10)
+        job = ExportJob.objects.create(
+            user=self.user, status=ExportJob.RUNNING, started=started,
+            attempts=settings.EXPORT_JOB_ATTEMPTS - 1)
+        self.assertEqual(self.claim(), job)
+        ExportJob.objects.filter(id=job.id).update(started=started)
+        self.assertIsNone(self.claim())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.FAILED)
+        self.assertEqual(job.attempts, settings.EXPORT_JOB_ATTEMPTS)
+
+
+def image_data_uri(image_format='PNG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', (2, 2), 'red').save(buffer, image_format)
+    content = base64.b64encode(buffer.getvalue()).decode()
+    return f'data:image/{image_format.lower()};base64,{content}'
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class RecipeWriteTest(RecipesTestCase):
+    """Создание и изменение рецепта через API."""
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def recipe_data(self, **fields):
+        return {
+            'name': 'Новый рецепт', 'text': 'Описание', 'cooking_time': 5,
+            'image': image_data_uri(), 'tags': [self.tags[0].id],
+            'ingredients': [
+                {'id': ingredient.id, 'amount': 10}
+                for ingredient in self.ingredients],
+            **fields}
+
+    def post(self, **fields):
+        return self.client.post(
+            '/api/recipes/', self.recipe_data(**fields), format='json')
+
+    def test_image_is_checked_on_upload(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 201)
+        recipe = Recipe.objects.get(id=response.data['id'])
+        self.assertEqual(recipe.image_status, Recipe.IMAGE_PENDING)
+        self.assertTrue(recipe.image_source.name.endswith('.png'))
+        for image in ('data:image/png;base64,не-base64',
+                      'data:image/png;base64,'
+                      + base64.b64encode(b'not an image').decode()):
+            with self.subTest(image=image):
+                response = self.post(image=image)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('image', response.data)
+
+    def test_create(self):
+        response = self.post(tags=[tag.id for tag in self.tags])
+        self.assertEqual(response.status_code, 201)
+        recipe = Recipe.objects.get(id=response.data['id'])
+        self.assertEqual(recipe.author, self.user)
+        self.assertEqual(
+            set(recipe.tags.values_list('id', flat=True)),
+            {tag.id for tag in self.tags})
+        self.assertEqual(
+            dict(recipe.recipe.values_list('ingredient_id', 'amount')),
+            {ingredient.id: 10 for ingredient in self.ingredients})
+        self.assertTrue(DirtyRecipe.objects.filter(
+            recipe_id=recipe.id).exists())
+
+    def test_create_is_atomic(self):
+        count = Recipe.objects.count()
+        with mock.patch.object(
+                RecipeIngredient.objects, 'bulk_create',
+                side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            self.post()
+        self.assertEqual(Recipe.objects.count(), count)
+
+    def test_per_item_errors(self):
+        first, second, _ = self.ingredients
+        response = self.post(
+            ingredients=[
+                {'id': first.id, 'amount': 1},
+                {'id': 10 ** 6, 'amount': 1},
+                {'id': first.id, 'amount': 1},
+                {'id': second.id, 'amount': 1}],
+            tags=[self.tags[0].id, 10 ** 6, self.tags[0].id])
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        self.assertEqual(
+            [bool(error) for error in errors['ingredients']],
+            [False, True, True, False])
+        self.assertIn(str(10 ** 6), errors['ingredients'][1]['id'][0])
+        self.assertEqual(set(errors['tags']), {'1', '2'})
+
+
+class RecipeUpdateTest(RecipesTestCase):
+    """Изменение рецепта: правим только разницу в составе."""
+
+    def setUp(self):
+        super().setUp()
+        self.author_client = APIClient()
+        self.author_client.force_authenticate(self.author)
+        self.recipe = self.recipes[1]
+
+    def patch(self, data):
+        return self.author_client.patch(
+            f'/api/recipes/{self.recipe.id}/', data, format='json')
+
+    def amounts(self):
+        return dict(self.recipe.recipe.values_list('ingredient_id', 'amount'))
+
+    def assert_shopping_list(self):
+        self.assertEqual(
+            ShoppingListItem.objects.stored([self.user.id]),
+            ShoppingListItem.objects.computed([self.user.id]))
+
+    def test_update_ingredients(self):
+        first, second, third = self.ingredients
+        rows = dict(self.recipe.recipe.values_list('ingredient_id', 'id'))
+        response = self.patch({'ingredients': [
+            {'id': first.id, 'amount': 100},
+            {'id': second.id, 'amount': 250}]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.amounts(), {first.id: 100, second.id: 250})
+        self.assertTrue(DirtyRecipe.objects.filter(
+            recipe_id=self.recipe.id).exists())
+        # Оставшиеся строки не пересоздаются.
+        self.assertEqual(
+            dict(self.recipe.recipe.values_list('ingredient_id', 'id')),
+            {first.id: rows[first.id], second.id: rows[second.id]})
+        self.assert_shopping_list()
+        self.patch({'ingredients': [
+            {'id': third.id, 'amount': 5}], 'tags': [self.tags[1].id]})
+        self.assertEqual(self.amounts(), {third.id: 5})
+        self.assertEqual(
+            list(self.recipe.tags.values_list('id', flat=True)),
+            [self.tags[1].id])
+        self.assert_shopping_list()
+        self.assertEqual(self.author_client.delete(
+            f'/api/recipes/{self.recipe.id}/').status_code, 204)
+        self.assert_shopping_list()
+        self.assertFalse(ShoppingListItem.objects.filter(
+            user=self.user).exists())
+
+    def test_update_is_atomic(self):
+        before = self.amounts()
+        with mock.patch.object(
+                RecipeIngredient.objects, 'bulk_update',
+                side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            self.patch({'name': 'Новое название', 'ingredients': [
+                {'id': ingredient.id, 'amount': 1}
+                for ingredient in self.ingredients[:2]]})
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.amounts(), before)
+        self.assertNotEqual(self.recipe.name, 'Новое название')
+
+
+class CollectionCountersTest(RecipesTestCase):
+    """Счетчики избранного и корзины не сбиваются на повторах."""
+
+    def test_duplicate_add_and_remove(self):
+        recipe = self.recipes[2]
+        for path, field in (('favorite', 'favorites_count'),
+                            ('shopping_cart', 'in_carts_count')):
+            with self.subTest(path=path):
+                url = f'/api/recipes/{recipe.id}/{path}/'
+                self.assertEqual(self.client.post(url).status_code, 201)
+                self.assertEqual(self.client.post(url).status_code, 400)
+                recipe.refresh_from_db()
+                self.assertEqual(getattr(recipe, field), 1)
+                self.assertEqual(self.client.delete(url).status_code, 204)
+                self.assertEqual(self.client.delete(url).status_code, 400)
+                recipe.refresh_from_db()
+                self.assertEqual(getattr(recipe, field), 0)
+        self.assertEqual(RecipeActivity.objects.filter(
+            recipe=recipe).count(), 2)
+
+
+class TrendingTest(RecipesTestCase):
+    """Популярные рецепты по действиям пользователей."""
+
+    def get_ids(self, params=None):
+        response = self.anonymous.get('/api/recipes/trending/', params)
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data]
+
+    def test_ordering(self):
+        first, second, third = self.recipes[:3]
+        RecipeActivity.objects.bulk_create(
+            [RecipeActivity(recipe=second, kind=RecipeActivity.FAVORITE)] * 3
+            + [RecipeActivity(recipe=first, kind=RecipeActivity.CART)]
+            + [RecipeActivity(recipe=third, kind=RecipeActivity.FAVORITE)])
+        old = RecipeActivity.objects.create(
+            recipe=self.recipes[3], kind=RecipeActivity.CART)
+        RecipeActivity.objects.filter(id=old.id).update(
+            created=timezone.now() - timedelta(
+                days=settings.TRENDING_WINDOW + 1))
+        call_command('compute_trending', stdout=io.StringIO())
+        self.assertEqual(self.get_ids(), [second.id, first.id, third.id])
+        self.assertEqual(
+            self.get_ids({'tags': 'dinner'}), [second.id, first.id, third.id])
+        self.assertEqual(self.get_ids({'limit': 1}), [second.id])
+        response = self.anonymous.get(
+            '/api/recipes/trending/', {'tags': 'unknown'})
+        self.assertEqual(response.status_code, 400)
+
+
+class PantryTest(RecipesTestCase):
+    """Что приготовить из своих продуктов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.products = [
+            Ingredient.objects.create(name=f'Продукт {index}',
+                                      measurement_unit='г')
+            for index in range(4)]
+        first, second, third, fourth = cls.products
+        cls.pantry = []
+        for name, ingredients in (('Два из двух', (first, second)),
+                                  ('Два из трех', (first, second, third)),
+                                  ('Один из двух', (first, fourth)),
+                                  ('Ни одного', (third, fourth))):
+            recipe = Recipe.objects.create(
+                author=cls.author, name=name, text='Описание',
+                cooking_time=10, image='static/recipe/image.jpg')
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=1)
+                for ingredient in ingredients)
+            cls.pantry.append(recipe)
+
+    def setUp(self):
+        super().setUp()
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        index_settings = override_settings(SIMILARITY_INDEX_DIR=index_dir)
+        index_settings.enable()
+        self.addCleanup(index_settings.disable)
+
+    def search(self, **params):
+        response = self.anonymous.get('/api/recipes/pantry/', {
+            'ingredients': [product.id for product in self.products[:2]],
+            **params})
+        self.assertEqual(response.status_code, 200)
+        return [(recipe['id'], recipe['missing_count'])
+                for recipe in response.data]
+
+    def test_ordering(self):
+        """Первыми — где докупать меньше, затем где продукты покрывают
+        большую долю рецепта."""
+
+        whole, most, half, _ = self.pantry
+        expected = [(whole.id, 0), (most.id, 1), (half.id, 1)]
+        DirtyRecipe.objects.mark(recipe.id for recipe in self.pantry)
+        # Без индекса рецепты считаются по БД, порядок тот же.
+        self.assertEqual(self.search(), expected)
+        call_command('build_similarity_index', stdout=io.StringIO())
+        self.assertEqual(self.search(), expected)
+        self.assertEqual(self.search(limit=2), expected[:2])
+        RecipeIngredient.objects.filter(recipe=most).delete()
+        DirtyRecipe.objects.mark([most.id])
+        self.assertEqual(self.search(), [expected[0], expected[2]])
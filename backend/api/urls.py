@@ -3,7 +3,7 @@ from rest_framework.routers import DefaultRouter
 
 from api.views import (AddDeleteFavoriteRecipe,AddAndDeleteSubscribe,
                        AddDeleteShoppingCart,
-                       AuthToken, IngredientsViewSet,
+                       AuthToken, ExportJobViewSet, IngredientsViewSet,
                        RecipesViewSet, TagsViewSet, UsersViewSet, set_password)
 
 app_name = 'api'
@@ -13,6 +13,7 @@ router.register('users', UsersViewSet)
 router.register('tags', TagsViewSet)
 router.register('ingredients', IngredientsViewSet)
 router.register('recipes', RecipesViewSet)
+router.register('exports', ExportJobViewSet, basename='exports')
 
 
 urlpatterns = [
@@ -1,16 +1,14 @@
-import io
-
 from django.contrib.auth import get_user_model
 from django.contrib.auth.hashers import make_password
-from django.db.models.aggregates import Sum, Count
+from django.db import transaction
+from django.db.models import F, Prefetch
 from django.db.models.expressions import Exists, OuterRef, Value
-from django.http import FileResponse
+from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase import pdfmetrics, ttfonts
-from reportlab.pdfgen import canvas
-from rest_framework import generics, status, viewsets
+from rest_framework import generics, mixins, status, viewsets
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.decorators import action, api_view
@@ -19,11 +17,22 @@ from rest_framework.permissions import (SAFE_METHODS, AllowAny,
                                         IsAuthenticatedOrReadOnly)
 from rest_framework.response import Response
 
-from api.filters import IngredientFilter, RecipeFilter
+from api.catalog import ingredient_catalog, tag_catalog
+from api.cache import AnonymousCacheMixin, ConditionalGetMixin
+from api.filters import (IngredientFilter, RecipeFilter,
+                         RecipeSearchFilter)
 from api.permissions import IsAdminOrReadOnly
-from recipes.models import (FavoriteRecipe, Ingredient, Recipe, ShoppingCart,
-                            Subscribe, Tag)
-from .serializers import (IngredientSerializer, RecipeReadSerializer,
+from api.negotiation import IgnoreFormatContentNegotiation
+from api.pagination import FeedPagination, LimitCursorPagination
+from api.shopping_list import EXPORT_FORMATS, stream_export
+from recipes.models import (ExportJob, FavoriteRecipe, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCart,
+                            RecipeActivity, RecipeScore, Subscribe, Tag,
+                            TimelineEntry)
+from recipes.similarity import pantry_recipes, similar_recipes
+
+from .serializers import (ExportJobSerializer, IngredientSerializer,
+                          RecipeReadSerializer, RecipeRowsSerializer,
                           RecipeWriteSerializer, SubscribeRecipeSerializer,
                           TagSerializer, SubscribeSerializer,
                           TokenSerializer, UserCreateSerializer,
@@ -32,7 +41,14 @@ from .serializers import (IngredientSerializer, RecipeReadSerializer,
 
 
 User = get_user_model()
-FILENAME = 'shoppingcart.pdf'
+# Поле ответа -> колонка модели для only() при ?fields=
+RECIPE_COLUMNS = {
+    'name': 'name', 'image': 'image', 'images': 'images', 'text': 'text',
+    'cooking_time': 'cooking_time', 'author': 'author'}
+USER_COLUMNS = {
+    'email': 'email', 'username': 'username',
+    'first_name': 'first_name', 'last_name': 'last_name'}
+FILENAME = 'shoppingcart.{}'
 
 
 class GetObjectMixin:
@@ -48,6 +64,74 @@ class GetObjectMixin:
         return recipe
 
 
+class SparseFieldsetMixin:
+    """Миксина для ?fields= и ?expand= на чтении.
+
+    fields — какие поля верхнего уровня отдать, expand — какие вложенные
+    объекты раскрыть (остальные отдаются id). Без параметра — все."""
+
+    def get_query_set_param(self, name):
+        value = self.request.query_params.get(name)
+        if value is None or self.request.method not in SAFE_METHODS:
+            return None
+        return {item.strip() for item in value.split(',') if item.strip()}
+
+    def wants(self, field):
+        fields = self.get_query_set_param('fields')
+        return fields is None or field in fields
+
+    def expands(self, field):
+        expand = self.get_query_set_param('expand')
+        return expand is None or field in expand
+
+    def get_columns(self, columns, always=('id',)):
+        """Колонки для only() или None, если нужны все."""
+
+        fields = self.get_query_set_param('fields')
+        if fields is None:
+            return None
+        return set(always) | {
+            column for field, column in columns.items() if field in fields}
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['sparse_fields'] = self.get_query_set_param('fields')
+        context['expand'] = self.get_query_set_param('expand')
+        return context
+
+
+class RowsListMixin:
+    """Миксина для списка из строк values() без экземпляров моделей.
+
+    Включается, только если клиент не просил ?fields= и ?expand=."""
+
+    rows_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        if (self.get_query_set_param('fields') is not None
+                or self.get_query_set_param('expand') is not None):
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_rows_queryset())
+        page = self.paginate_queryset(queryset)
+        rows = queryset if page is None else page
+        data = self.rows_serializer_class(
+            rows, context=self.get_serializer_context()).data
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
+
+
+class AutocompleteMixin:
+    """Миксина для поиска ингредиентов по ?name= из справочника в памяти."""
+
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if not name:
+            return super().list(request, *args, **kwargs)
+        return Response(ingredient_catalog.search(
+            name, settings.INGREDIENT_AUTOCOMPLETE_LIMIT))
+
+
 class PermissionAndPaginationMixin:
     """Миксина для списка тегов и ингридиентов."""
 
@@ -64,11 +148,8 @@ class AddAndDeleteSubscribe(
 
     def get_queryset(self):
         return self.request.user.follower.select_related(
-            'following'
-        ).prefetch_related(
-            'following__recipe'
+            'author'
         ).annotate(
-            recipes_count=Count('following__recipe'),
             is_subscribed=Value(True), )
 
     def get_object(self):
@@ -91,36 +172,83 @@ class AddAndDeleteSubscribe(
         self.request.user.follower.filter(author=instance).delete()
 
 
-class AddDeleteFavoriteRecipe(
-        GetObjectMixin,
-        generics.RetrieveDestroyAPIView,
-        generics.ListCreateAPIView):
-    """Добавление и удаление рецепта в/из избранных."""
+class AddDeleteRecipeMixin(GetObjectMixin):
+    """Миксина для избранного и корзины: добавляем рецепт в коллекцию
+    пользователя и держим в актуальном состоянии счетчик рецепта."""
+
+    collection_model = None
+    counter_field = None
+    activity_kind = None
+    already_added_msg = None
+    not_found_msg = None
+
+    def get_collection(self):
+        """Коллекция под блокировкой, чтобы не посчитать рецепт дважды."""
 
+        return self.collection_model.objects.select_for_update().get(
+            user=self.request.user)
+
+    def update_counter(self, recipe, delta):
+        Recipe.objects.filter(id=recipe.id).update(
+            **{self.counter_field: F(self.counter_field) + delta})
+
+    def recipe_added(self, recipe):
+        self.update_counter(recipe, 1)
+        RecipeActivity.objects.create(recipe=recipe, kind=self.activity_kind)
+
+    def recipe_removed(self, recipe):
+        self.update_counter(recipe, -1)
+
+    @transaction.atomic
     def create(self, request, *args, **kwargs):
         instance = self.get_object()
-        request.user.favorite_recipe.recipe.add(instance)
+        collection = self.get_collection()
+        if collection.recipe.filter(id=instance.id).exists():
+            return Response(
+                {'errors': self.already_added_msg},
+                status=status.HTTP_400_BAD_REQUEST)
+        collection.recipe.add(instance)
+        self.recipe_added(instance)
         serializer = self.get_serializer(instance)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-    def perform_destroy(self, instance):
-        self.request.user.favorite_recipe.recipe.remove(instance)
+    @transaction.atomic
+    def destroy(self, request, *args, **kwargs):
+        instance = self.get_object()
+        collection = self.get_collection()
+        if not collection.recipe.filter(id=instance.id).exists():
+            return Response(
+                {'errors': self.not_found_msg},
+                status=status.HTTP_400_BAD_REQUEST)
+        collection.recipe.remove(instance)
+        self.recipe_removed(instance)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class AddDeleteFavoriteRecipe(
+        AddDeleteRecipeMixin,
+        generics.RetrieveDestroyAPIView,
+        generics.ListCreateAPIView):
+    """Добавление и удаление рецепта в/из избранных."""
+
+    collection_model = FavoriteRecipe
+    counter_field = 'favorites_count'
+    activity_kind = RecipeActivity.FAVORITE
+    already_added_msg = 'Рецепт уже в избранном.'
+    not_found_msg = 'Рецепта нет в избранном.'
 
 
 class AddDeleteShoppingCart(
-        GetObjectMixin,
+        AddDeleteRecipeMixin,
         generics.RetrieveDestroyAPIView,
         generics.ListCreateAPIView):
     """Добавление и удаление рецепта в/из корзины."""
 
-    def create(self, request, *args, **kwargs):
-        instance = self.get_object()
-        request.user.shopping_cart.recipe.add(instance)
-        serializer = self.get_serializer(instance)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-    def perform_destroy(self, instance):
-        self.request.user.shopping_cart.recipe.remove(instance)
+    collection_model = ShoppingCart
+    counter_field = 'in_carts_count'
+    activity_kind = RecipeActivity.CART
+    already_added_msg = 'Рецепт уже в списке покупок.'
+    not_found_msg = 'Рецепта нет в списке покупок.'
 
 
 class AuthToken(ObtainAuthToken):
@@ -139,19 +267,26 @@ class AuthToken(ObtainAuthToken):
             status=status.HTTP_201_CREATED)
 
 
-class UsersViewSet(UserViewSet):
+class UsersViewSet(ConditionalGetMixin, SparseFieldsetMixin, UserViewSet):
     """Пользователи."""
+    cache_models = (User,)
     serializer_class = UserListSerializer
     permission_classes = (IsAuthenticated,)
+    pagination_class = FeedPagination
+    cursor_ordering = ('id',)
 
     def get_queryset(self):
-        return User.objects.annotate(
+        queryset = User.objects.all()
+        columns = self.get_columns(USER_COLUMNS)
+        if columns is not None:
+            queryset = queryset.only(*columns)
+        if not self.wants('is_subscribed'):
+            return queryset
+        return queryset.annotate(
             is_subscribed=Exists(
                 self.request.user.follower.filter(
                     author=OuterRef('id'))
-            )).prefetch_related(
-                'follower', 'following'
-        ) if self.request.user.is_authenticated else User.objects.annotate(
+            )) if self.request.user.is_authenticated else queryset.annotate(
             is_subscribed=Value(False))
 
     def get_serializer_class(self):
@@ -165,12 +300,14 @@ class UsersViewSet(UserViewSet):
 
     @action(
         detail=False,
-        permission_classes=(IsAuthenticated,))
+        permission_classes=(IsAuthenticated,),
+        cursor_ordering=('-created', '-id'))
     def subscriptions(self, request):
         """Получить на кого пользователь подписан."""
 
         user = request.user
-        queryset = Subscribe.objects.filter(user=user)
+        queryset = Subscribe.objects.filter(user=user).select_related(
+            'author').annotate(is_subscribed=Value(True))
         pages = self.paginate_queryset(queryset)
         serializer = SubscribeSerializer(
             pages, many=True,
@@ -178,12 +315,22 @@ class UsersViewSet(UserViewSet):
         return self.get_paginated_response(serializer.data)
 
 
-class RecipesViewSet(viewsets.ModelViewSet):
+class RecipesViewSet(
+        ConditionalGetMixin,
+        AnonymousCacheMixin,
+        RowsListMixin,
+        SparseFieldsetMixin,
+        viewsets.ModelViewSet):
     """Рецепты."""
 
+    cache_models = (Recipe, Tag, Ingredient, User)
+    rows_serializer_class = RecipeRowsSerializer
     queryset = Recipe.objects.all()
+    filter_backends = (DjangoFilterBackend, RecipeSearchFilter)
     filterset_class = RecipeFilter
     permission_classes = (IsAuthenticatedOrReadOnly,)
+    pagination_class = FeedPagination
+    cursor_ordering = LimitCursorPagination.ordering
 
     def get_serializer_class(self):
         if self.request.method in SAFE_METHODS:
@@ -191,87 +338,239 @@ class RecipesViewSet(viewsets.ModelViewSet):
         return RecipeWriteSerializer
 
     def get_queryset(self):
-        return Recipe.objects.annotate(
+        queryset = Recipe.objects.all()
+        columns = self.get_columns(RECIPE_COLUMNS, always=('id', 'pub_date'))
+        if columns is not None:
+            queryset = queryset.only(*columns)
+        else:
+            queryset = queryset.defer('search_vector')
+        if self.wants('tags'):
+            queryset = queryset.prefetch_related(
+                'tags' if self.expands('tags')
+                else Prefetch('tags', queryset=Tag.objects.only('id')))
+        if self.wants('ingredients'):
+            queryset = queryset.prefetch_related(Prefetch(
+                'recipe',
+                queryset=RecipeIngredient.objects.select_related(
+                    'ingredient') if self.expands('ingredients')
+                else RecipeIngredient.objects.only(
+                    'id', 'recipe_id', 'ingredient_id', 'amount')))
+        user = self.request.user
+        if self.wants('author') and self.expands('author'):
+            if not user.is_authenticated:
+                queryset = queryset.select_related('author')
+            else:
+                queryset = queryset.prefetch_related(Prefetch(
+                    'author',
+                    queryset=User.objects.annotate(
+                        is_subscribed=Exists(
+                            user.follower.filter(author=OuterRef('id'))))))
+        return self.annotate_flags(queryset)
+
+    def annotate_flags(self, queryset):
+        user = self.request.user
+        if not user.is_authenticated:
+            return queryset.annotate(
+                is_in_shopping_cart=Value(False),
+                is_favorited=Value(False))
+        return queryset.annotate(
             is_favorited=Exists(
                 FavoriteRecipe.objects.filter(
-                    user=self.request.user, recipe=OuterRef('id'))),
+                    user=user, recipe=OuterRef('id'))),
             is_in_shopping_cart=Exists(
                 ShoppingCart.objects.filter(
-                    user=self.request.user,
-                    recipe=OuterRef('id')))
-        ).select_related('author').prefetch_related(
-            'tags', 'ingredients', 'recipe',
-            'shopping_cart', 'favorite_recipe'
-        ) if self.request.user.is_authenticated else Recipe.objects.annotate(
-            is_in_shopping_cart=Value(False),
-            is_favorited=Value(False),
-        ).select_related('author').prefetch_related(
-            'tags', 'ingredients', 'recipe',
-            'shopping_cart', 'favorite_recipe')
+                    user=user, recipe=OuterRef('id'))))
+
+    def get_rows_queryset(self):
+        return self.annotate_flags(Recipe.objects.all()).values(
+            *RecipeRowsSerializer.columns)
+
+    def get_limit(self, default):
+        """?limit= не больше default, без параметра — default."""
+
+        limit = self.request.query_params.get('limit', '')
+        return min(int(limit) if limit.isdigit() else default, default)
+
+    def rows_for_ids(self, recipe_ids, queryset=None):
+        """Строки рецептов в порядке recipe_ids, пропавшие пропускаем."""
+
+        if queryset is None:
+            queryset = self.get_rows_queryset()
+        rows = {row['id']: row for row in queryset.filter(id__in=recipe_ids)}
+        return [rows[recipe_id] for recipe_id in recipe_ids
+                if recipe_id in rows]
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
+    @action(detail=False, pagination_class=None)
+    def trending(self, request):
+        """Популярные рецепты, ?tags= — рейтинг внутри тега."""
+
+        slug = request.query_params.get('tags')
+        tag_id = None
+        if slug:
+            tag_ids = [
+                tag['id'] for tag in tag_catalog.get().values()
+                if tag['slug'] == slug]
+            if not tag_ids:
+                return Response(
+                    {'errors': f'Тега {slug} нет.'},
+                    status=status.HTTP_400_BAD_REQUEST)
+            tag_id, = tag_ids
+        limit = self.get_limit(settings.TRENDING_SIZE)
+        recipe_ids = list(RecipeScore.objects.filter(
+            tag_id=tag_id).order_by('-score').values_list(
+                'recipe_id', flat=True)[:limit])
+        return Response(RecipeRowsSerializer(
+            self.rows_for_ids(recipe_ids),
+            context=self.get_serializer_context()).data)
+
+    @action(detail=True, pagination_class=None)
+    def similar(self, request, pk=None):
+        """Рецепты с похожим набором ингредиентов, самые похожие первыми."""
+
+        recipe = get_object_or_404(Recipe.objects.only('id'), pk=pk)
+        limit = self.get_limit(settings.SIMILAR_RECIPES_LIMIT)
+        recipe_ids = [
+            recipe_id for recipe_id, _ in similar_recipes(recipe.id, limit)]
+        return Response(RecipeRowsSerializer(
+            self.rows_for_ids(recipe_ids),
+            context=self.get_serializer_context()).data)
+
+    @action(detail=False, pagination_class=None)
+    def pantry(self, request):
+        """Что приготовить из своих продуктов: ?ingredients= — id
+        ингредиентов, первыми рецепты, где докупать меньше всего.
+
+        Работают и остальные фильтры списка, например ?tags=."""
+
+        ingredient_ids = request.query_params.getlist('ingredients')
+        if not ingredient_ids or not all(
+                ingredient_id.isdigit() for ingredient_id in ingredient_ids):
+            return Response(
+                {'errors': 'Укажите id ингредиентов в ?ingredients=.'},
+                status=status.HTTP_400_BAD_REQUEST)
+        limit = self.get_limit(settings.PANTRY_SEARCH_LIMIT)
+        queryset = self.filter_queryset(self.get_rows_queryset())
+        rows, missing = [], {}
+        for chunk in pantry_recipes(
+                map(int, ingredient_ids), settings.PANTRY_SEARCH_CHUNK):
+            if len(rows) >= limit:
+                break
+            missing.update(chunk)
+            rows.extend(self.rows_for_ids(
+                [recipe_id for recipe_id, _ in chunk], queryset))
+        data = RecipeRowsSerializer(
+            rows[:limit], context=self.get_serializer_context()).data
+        for recipe in data:
+            recipe['missing_count'] = missing[recipe['id']]
+        return Response(data)
+
+    @action(
+        detail=False,
+        permission_classes=(IsAuthenticated,),
+        pagination_class=LimitCursorPagination,
+        cursor_ordering=('-pub_date', '-recipe_id'))
+    def timeline(self, request):
+        """Лента новых рецептов от авторов из подписок."""
+
+        TimelineEntry.objects.pull(request.user)
+        entries = self.paginate_queryset(
+            request.user.timeline.values('recipe_id', 'pub_date'))
+        data = RecipeRowsSerializer(
+            self.rows_for_ids([entry['recipe_id'] for entry in entries]),
+            context=self.get_serializer_context()).data
+        return self.get_paginated_response(data)
+
     @action(
         detail=False,
         methods=['get'],
-        permission_classes=(IsAuthenticated,))
+        permission_classes=(IsAuthenticated,),
+        content_negotiation_class=IgnoreFormatContentNegotiation)
     def download_shopping_cart(self, request):
-        """Качаем список с ингредиентами."""
-
-        buffer = io.BytesIO()
-        page = canvas.Canvas(buffer)
-        arial = ttfonts.TTFont('Arial', 'data/arial.ttf')
-        pdfmetrics.registerFont(arial)
-        x_position, y_position = 50, 800
-        shopping_cart = (
-            request.user.shopping_cart.recipe.
-            values(
-                'ingredients__name',
-                'ingredients__measurement_unit'
-            ).annotate(amount=Sum('recipe__amount')).order_by())
-        page.setFont('Arial', 14)
-        if shopping_cart:
-            indent = 20
-            page.drawString(x_position, y_position, 'Cписок покупок:')
-            for index, recipe in enumerate(shopping_cart, start=1):
-                page.drawString(
-                    x_position, y_position - indent,
-                    f'{index}. {recipe["ingredients__name"]} - '
-                    f'{recipe["amount"]} '
-                    f'{recipe["ingredients__measurement_unit"]}.')
-                y_position -= 15
-                if y_position <= 50:
-                    page.showPage()
-                    y_position = 800
-            page.save()
-            buffer.seek(0)
-            return FileResponse(
-                buffer, as_attachment=True, filename=FILENAME)
-        page.setFont('Arial', 24)
-        page.drawString(
-            x_position,
-            y_position,
-            'Cписок покупок пуст!')
-        page.save()
-        buffer.seek(0)
-        return FileResponse(buffer, as_attachment=True, filename=FILENAME)
+        """Качаем список с ингредиентами: ?format=pdf|txt|csv|json."""
+
+        export_format = request.query_params.get('format', 'pdf')
+        if export_format not in EXPORT_FORMATS:
+            return Response(
+                {'errors': f'Формат {export_format} не поддерживается.'},
+                status=status.HTTP_400_BAD_REQUEST)
+        content_type, _ = EXPORT_FORMATS[export_format]
+        response = StreamingHttpResponse(
+            stream_export(request.user, export_format),
+            content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="{FILENAME.format(export_format)}"')
+        return response
+
+
+class ExportJobViewSet(
+        mixins.CreateModelMixin,
+        mixins.RetrieveModelMixin,
+        viewsets.GenericViewSet):
+    """Фоновая выгрузка списка покупок: ставим в очередь и опрашиваем."""
+
+    serializer_class = ExportJobSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        return self.request.user.export_jobs.all()
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        active = self.get_queryset().filter(
+            status__in=(ExportJob.PENDING, ExportJob.RUNNING))
+        job = active.filter(
+            status=ExportJob.PENDING,
+            export_format=serializer.validated_data['export_format']
+        ).first()
+        if job is None:
+            if active.count() >= settings.EXPORT_JOBS_PER_USER:
+                return Response(
+                    {'errors': 'Слишком много выгрузок в очереди.'},
+                    status=status.HTTP_429_TOO_MANY_REQUESTS)
+            job = serializer.save(user=request.user)
+        return Response(
+            self.get_serializer(job).data,
+            status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True)
+    def download(self, request, pk=None):
+        """Забираем готовый файл."""
+
+        job = self.get_object()
+        if job.status != ExportJob.DONE:
+            return Response(
+                {'errors': 'Выгрузка еще не готова.'},
+                status=status.HTTP_400_BAD_REQUEST)
+        return FileResponse(
+            job.file.open('rb'), as_attachment=True,
+            filename=FILENAME.format(job.export_format))
 
 
 class TagsViewSet(
+        ConditionalGetMixin,
+        AnonymousCacheMixin,
         PermissionAndPaginationMixin,
         viewsets.ModelViewSet):
     """Список тэгов."""
 
+    cache_models = (Tag,)
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
 
 
 class IngredientsViewSet(
+        ConditionalGetMixin,
+        AnonymousCacheMixin,
+        AutocompleteMixin,
         PermissionAndPaginationMixin,
         viewsets.ModelViewSet):
     """Список ингредиентов."""
 
+    cache_models = (Ingredient,)
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     filterset_class = IngredientFilter
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,7 +12,7 @@ BASE_DIR = os.path.dirname(
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.1/howto/deployment/checklist/
 
-FONT_PATH = os.path.join(BASE_DIR, 'data/vera.ttf')
+FONT_PATH = os.path.join(BASE_DIR, 'data/arial.ttf')
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = ('SECRET_KEY', 'my_secret_code_35h4jilz@4zqj=rq&agdol^##zgl9(vs')
@@ -94,6 +95,28 @@ DATABASES = {
     }
 }
 
+# Кэш. По умолчанию файловый: в нем же версии таблиц для ETag и кэша
+# ответов, и они должны быть общими для всех воркеров gunicorn.
+# LocMemCache живет внутри одного процесса — только для запуска в один
+# процесс (CACHE_BACKEND=django.core.cache.backends.locmem.LocMemCache).
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv(
+            'CACHE_LOCATION',
+            default=os.path.join(tempfile.gettempdir(), 'foodgram_cache')),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
+# Сколько живет закэшированный ответ API для анонимов, сек.
+API_CACHE_TIMEOUT = 10 * 60
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -155,6 +178,64 @@ REST_FRAMEWORK = {
         'django_filters.rest_framework.DjangoFilterBackend',
         'rest_framework.filters.SearchFilter',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'api.pagination.LimitPageNumberPagination',
     'PAGE_SIZE': 6,
 }
+
+# Лента рецептов от подписок: длина ленты, порог подписчиков, после
+# которого рецепты автора не рассылаются, а забираются при чтении,
+# и размер пачки подписчиков при рассылке
+TIMELINE_LENGTH = 500
+TIMELINE_FANOUT_MAX_FOLLOWERS = 10000
+TIMELINE_FANOUT_BATCH = 1000
+
+# Популярные рецепты: вес добавления в избранное и в корзину, период
+# полураспада веса в часах, окно в днях и сколько мест храним в рейтинге
+TRENDING_WEIGHTS = {'favorite': 1.0, 'cart': 1.5}
+TRENDING_HALF_LIFE = 72
+TRENDING_WINDOW = 30
+TRENDING_SIZE = 100
+
+# Похожие рецепты: каталог индекса (общий для всех воркеров, читаем
+# через mmap) и сколько похожих рецептов отдаем максимум
+SIMILARITY_INDEX_DIR = os.getenv(
+    'SIMILARITY_INDEX_DIR', default=os.path.join(BASE_DIR, 'similarity'))
+SIMILAR_RECIPES_LIMIT = 50
+
+# Поиск рецептов по своим продуктам: сколько рецептов отдаем максимум
+# и сколько кандидатов из индекса проверяем фильтрами за один запрос к БД
+PANTRY_SEARCH_LIMIT = 50
+PANTRY_SEARCH_CHUNK = 500
+
+# Сколько ингредиентов отдаем в подсказке по ?name=
+INGREDIENT_AUTOCOMPLETE_LIMIT = 20
+
+# Кэш готовых PDF со списком покупок (LRU, лимит в байтах на процесс)
+SHOPPING_LIST_CACHE_BYTES = int(
+    os.getenv('SHOPPING_LIST_CACHE_BYTES', default=32 * 1024 * 1024))
+
+# Сколько строк списка покупок читаем из БД за раз при выгрузке
+SHOPPING_LIST_CHUNK_SIZE = 500
+
+# Фоновые выгрузки списка покупок: задач на пользователя, таймаут
+# зависшей задачи, сколько раз ее перезапускать, срок хранения файла
+EXPORT_JOBS_PER_USER = 3
+EXPORT_JOB_TIMEOUT = 5 * 60
+EXPORT_JOB_ATTEMPTS = 3
+EXPORT_JOB_TTL = 24 * 60 * 60
+
+# Обработка картинок: через сколько секунд зависшая картинка (воркер
+# упал) снова берется в работу и сколько попыток дается до ошибки
+IMAGE_JOB_TIMEOUT = 5 * 60
+IMAGE_JOB_ATTEMPTS = 3
+
+# Варианты картинки рецепта: имя -> максимальная сторона, px
+RECIPE_IMAGE_VARIANTS = {
+    'thumbnail': 160,
+    'card': 480,
+    'full': 1280,
+}
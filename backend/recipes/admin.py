@@ -1,7 +1,8 @@
 from django.contrib import admin
 
 from .models import (FavoriteRecipe, Ingredient, Recipe, RecipeIngredient,
-                     ShoppingCart, Subscribe, Tag)
+                     ShoppingCart, ShoppingListItem, Subscribe, Tag,
+                     ingredients_changed)
 
 EMPTY_MSG = '-пусто-'
 
@@ -24,6 +25,18 @@ class RecipeAdmin(admin.ModelAdmin):
     inlines = (RecipeIngredientAdmin,)
     empty_value_display = EMPTY_MSG
 
+    def save_related(self, request, form, formsets, change):
+        """Правку ингредиентов в инлайне переносим в списки покупок."""
+
+        recipe = form.instance
+        old_amounts = dict(
+            recipe.recipe.values_list('ingredient_id', 'amount'))
+        super().save_related(request, form, formsets, change)
+        ShoppingListItem.objects.change_recipe(
+            recipe, old_amounts,
+            dict(recipe.recipe.values_list('ingredient_id', 'amount')))
+        ingredients_changed([recipe.id])
+
     @admin.display(
         description='Электронная почта')
     def get_author(self, obj):
@@ -45,7 +58,7 @@ class RecipeAdmin(admin.ModelAdmin):
 
     @admin.display(description='В избранном')
     def get_favorite_count(self, obj):
-        return obj.favorite_recipe.count()
+        return obj.favorites_count
 
 
 @admin.register(Tag)
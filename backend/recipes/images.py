@@ -0,0 +1,92 @@
+import base64
+import binascii
+import io
+import re
+import struct
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, UnidentifiedImageError
+
+DATA_URI = re.compile(r'^data:image/[\w.+-]+;base64,')
+VARIANTS_DIR = 'recipe/variants/'
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True}),
+}
+
+
+class ImageError(Exception):
+    """Картинку не удалось разобрать."""
+
+
+def decode(raw):
+    """Байты картинки из data URI или из обычного файла."""
+
+    if raw[:5] != b'data:':
+        return raw
+    header, _, payload = raw.partition(b',')
+    try:
+        return base64.b64decode(payload, validate=True)
+    except binascii.Error as error:
+        raise ImageError('Некорректный base64.') from error
+
+
+def verify_image(raw):
+    """Проверяем картинку без декодирования пикселей.
+
+    Возвращаем байты и расширение по формату, битые данные — ImageError."""
+
+    data = decode(raw)
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image_format = image.format
+            image.verify()
+    # verify() бросает разное в зависимости от формата.
+    except (OSError, SyntaxError, ValueError, struct.error,
+            Image.DecompressionBombError) as error:
+        raise ImageError('Файл не является изображением.') from error
+    return data, image_format.lower()
+
+
+def make_variants(raw):
+    """Режем картинку на варианты: {вариант: {формат: ContentFile}}."""
+
+    try:
+        with Image.open(io.BytesIO(decode(raw))) as source:
+            source.load()
+            image = source.convert('RGB')
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError
+            ) as error:
+        raise ImageError('Файл не является изображением.') from error
+    stem = uuid4().hex
+    variants = {}
+    for variant, max_side in settings.RECIPE_IMAGE_VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail((max_side, max_side))
+        variants[variant] = {}
+        for extension, (image_format, options) in FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, **options)
+            variants[variant][extension] = ContentFile(
+                buffer.getvalue(),
+                name=f'{VARIANTS_DIR}{stem}-{variant}.{extension}')
+    return variants
+
+
+def save_variants(variants):
+    """Пишем варианты в хранилище, возвращаем карту имен файлов."""
+
+    return {
+        variant: {
+            extension: default_storage.save(content.name, content)
+            for extension, content in files.items()}
+        for variant, files in variants.items()}
+
+
+def delete_variants(images):
+    for files in images.values():
+        for name in files.values():
+            default_storage.delete(name)
@@ -0,0 +1,73 @@
+from array import array
+from time import perf_counter
+
+import numpy as np
+from django.core.management import BaseCommand
+from django.utils import timezone
+from scipy import sparse
+
+from recipes.models import DirtyRecipe, RecipeIngredient
+from recipes.similarity import idf_weights, save_index
+
+
+class Command(BaseCommand):
+    help = 'Сборка индекса похожих рецептов по ингредиентам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def read_pairs(self, chunk_size):
+        """Пары (рецепт, ингредиент) в компактные массивы, без списков
+        объектов Python на миллионы строк."""
+
+        recipes, ingredients = array('q'), array('q')
+        for recipe_id, ingredient_id in RecipeIngredient.objects.values_list(
+                'recipe_id', 'ingredient_id').order_by().iterator(
+                    chunk_size=chunk_size):
+            recipes.append(recipe_id)
+            ingredients.append(ingredient_id)
+        return (
+            np.frombuffer(recipes, dtype=np.int64),
+            np.frombuffer(ingredients, dtype=np.int64))
+
+    def build(self, recipe_column, ingredient_column):
+        recipe_ids, rows = np.unique(recipe_column, return_inverse=True)
+        ingredient_ids, columns = np.unique(
+            ingredient_column, return_inverse=True)
+        idf = idf_weights(
+            np.bincount(columns, minlength=len(ingredient_ids)),
+            len(recipe_ids)).astype(np.float32)
+        data = idf[columns]
+        norms = np.sqrt(np.bincount(
+            rows, weights=data.astype(np.float64) ** 2,
+            minlength=len(recipe_ids))).astype(np.float32)
+        data /= norms[rows]
+        matrix = sparse.csc_matrix(
+            (data, (rows, columns)),
+            shape=(len(recipe_ids), len(ingredient_ids)), dtype=np.float32)
+        matrix.sort_indices()
+        return {
+            'recipe_ids': recipe_ids,
+            'recipe_sizes': np.bincount(
+                rows, minlength=len(recipe_ids)).astype(np.int32),
+            'ingredient_ids': ingredient_ids,
+            'idf': idf,
+            'csc_indptr': matrix.indptr,
+            'csc_indices': matrix.indices,
+            'csc_data': matrix.data}
+
+    def handle(self, *args, **options):
+        started = timezone.now()
+        timer = perf_counter()
+        arrays = self.build(*self.read_pairs(options['chunk_size']))
+        build = started.strftime('%Y%m%d%H%M%S%f')
+        save_index(build, arrays, {
+            'started': started.isoformat(),
+            'recipes': len(arrays['recipe_ids']),
+            'ingredients': len(arrays['ingredient_ids'])})
+        # Рецепты, измененные во время сборки, остаются в оверлее.
+        DirtyRecipe.objects.filter(changed__lte=started).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Индекс {build}: рецептов {len(arrays["recipe_ids"])}, '
+            f'ингредиентов {len(arrays["ingredient_ids"])}, '
+            f'{perf_counter() - timer:.1f} с'))
@@ -0,0 +1,80 @@
+import heapq
+import math
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from recipes.models import Recipe, RecipeActivity, RecipeScore
+
+
+class Command(BaseCommand):
+    help = 'Пересчет рейтинга популярных рецептов с затуханием по времени'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def recipe_batches(self, since, batch_size):
+        active = RecipeActivity.objects.filter(
+            created__gte=since).values_list(
+                'recipe_id', flat=True).distinct().order_by('recipe_id')
+        last_id = 0
+        while True:
+            batch = list(active.filter(recipe_id__gt=last_id)[:batch_size])
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1]
+
+    def scores(self, recipe_ids, since, now):
+        """Сумма весов действий, вес падает вдвое за TRENDING_HALF_LIFE.
+
+        Действия схлопываем по часам, чтобы не тащить каждое из БД."""
+
+        decay = math.log(2) / (settings.TRENDING_HALF_LIFE * 3600)
+        weights = settings.TRENDING_WEIGHTS
+        scores = defaultdict(float)
+        for recipe_id, kind, hour, total in RecipeActivity.objects.filter(
+                recipe_id__in=recipe_ids, created__gte=since
+        ).annotate(hour=TruncHour('created')).values_list(
+                'recipe_id', 'kind', 'hour').annotate(
+                total=Count('*')).order_by():
+            age = (now - hour).total_seconds()
+            scores[recipe_id] += (
+                weights[kind] * total * math.exp(-decay * age))
+        return scores
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        since = now - timedelta(days=settings.TRENDING_WINDOW)
+        RecipeActivity.objects.filter(created__lt=since).delete()
+        size = settings.TRENDING_SIZE
+        # Держим только лучшие size мест в каждом рейтинге: кучи по тегам.
+        tops = defaultdict(list)
+        for batch in self.recipe_batches(since, options['batch_size']):
+            scores = self.scores(batch, since, now)
+            tags = defaultdict(list)
+            for recipe_id, tag_id in Recipe.tags.through.objects.filter(
+                    recipe_id__in=batch).values_list('recipe_id', 'tag_id'):
+                tags[recipe_id].append(tag_id)
+            for recipe_id, score in scores.items():
+                for tag_id in [None, *tags[recipe_id]]:
+                    top = tops[tag_id]
+                    if len(top) < size:
+                        heapq.heappush(top, (score, recipe_id))
+                    elif score > top[0][0]:
+                        heapq.heapreplace(top, (score, recipe_id))
+        with transaction.atomic():
+            RecipeScore.objects.all().delete()
+            RecipeScore.objects.bulk_create(
+                RecipeScore(recipe_id=recipe_id, tag_id=tag_id, score=score)
+                for tag_id, top in tops.items()
+                for score, recipe_id in top)
+        self.stdout.write(self.style.SUCCESS(
+            f'Рейтинг пересчитан: {len(tops.get(None, []))} рецептов, '
+            f'тегов: {len(tops) - (None in tops)}'))
@@ -0,0 +1,257 @@
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+import django
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+
+from api.cache import bump_version
+from recipes.images import (DATA_URI, ImageError, delete_variants,
+                            make_variants, save_variants)
+from recipes.models import (ImportCheckpoint, Ingredient, Recipe,
+                            RecipeIngredient, Tag, enqueue_fanout,
+                            ingredients_changed, update_user_counter)
+
+User = get_user_model()
+MAX_COOKING_TIME = 32767
+
+
+def render_image(image, base_dir):
+    """В дочернем процессе: варианты картинки в виде байтов.
+
+    Картинка — data URI или путь к файлу относительно файла импорта."""
+
+    try:
+        if DATA_URI.match(image):
+            raw = image.encode()
+        else:
+            raw = (Path(base_dir) / image).read_bytes()
+        return {
+            variant: {
+                extension: (content.name, content.read())
+                for extension, content in files.items()}
+            for variant, files in make_variants(raw).items()}, None
+    except (ImageError, OSError) as error:
+        return None, str(error)
+
+
+class Command(BaseCommand):
+    help = 'Импорт рецептов из JSON Lines пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл .jsonl, рецепт на строку.')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Процессов для обработки картинок.')
+        parser.add_argument(
+            '--checkpoint',
+            help='Имя контрольной точки: номер последней загруженной строки '
+                 'хранится в БД, повторный запуск продолжит после нее.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только проверить файл, ничего не записывая.')
+
+    def load_lookups(self):
+        self.authors = dict(User.objects.values_list('email', 'id'))
+        self.tags = dict(Tag.objects.values_list('slug', 'id'))
+        self.ingredients = {
+            (name, unit): ingredient_id
+            for ingredient_id, name, unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit')}
+
+    def parse(self, line):
+        """Строка файла -> поля рецепта, id тегов и ингредиентов."""
+
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError as error:
+            raise ValueError(f'некорректный JSON: {error}') from error
+        if not isinstance(data, dict):
+            raise ValueError('ожидается объект')
+        author_id = self.authors.get(data.get('author'))
+        if author_id is None:
+            raise ValueError(f'нет автора {data.get("author")}')
+        name, text = data.get('name'), data.get('text')
+        if not isinstance(name, str) or not name or len(name) > 255:
+            raise ValueError('некорректное название')
+        if not isinstance(text, str) or not text:
+            raise ValueError('не задано описание')
+        cooking_time = data.get('cooking_time')
+        if (not isinstance(cooking_time, int)
+                or not 1 <= cooking_time <= MAX_COOKING_TIME):
+            raise ValueError('некорректное время приготовления')
+        image = data.get('image')
+        if not isinstance(image, str) or not image:
+            raise ValueError('не задана картинка')
+        return {
+            'recipe': Recipe(
+                author_id=author_id, name=name, text=text,
+                cooking_time=cooking_time),
+            'image': image,
+            'tags': self.parse_tags(data.get('tags') or []),
+            'amounts': self.parse_ingredients(data.get('ingredients') or [])}
+
+    def parse_tags(self, tags):
+        tag_ids = [
+            self.tags.get(slug) if isinstance(slug, str) else None
+            for slug in tags]
+        if not tag_ids or None in tag_ids:
+            raise ValueError(f'неизвестные теги: {tags}')
+        if len(set(tag_ids)) != len(tag_ids):
+            raise ValueError('теги повторяются')
+        return tag_ids
+
+    def parse_ingredients(self, ingredients):
+        amounts = {}
+        for item in ingredients:
+            if not isinstance(item, dict):
+                raise ValueError('ингредиент должен быть объектом')
+            key = (item.get('name'), item.get('measurement_unit'))
+            ingredient_id = self.ingredients.get(key)
+            if ingredient_id is None:
+                raise ValueError(f'нет ингредиента {key[0]}, {key[1]}')
+            if ingredient_id in amounts:
+                raise ValueError(f'ингредиент {key[0]} повторяется')
+            amount = item.get('amount')
+            if not isinstance(amount, int) or amount < 1:
+                raise ValueError(f'некорректное количество {key[0]}')
+            amounts[ingredient_id] = amount
+        if not amounts:
+            raise ValueError('не заданы ингредиенты')
+        return amounts
+
+    def render_images(self, entries):
+        """Режем картинки пачки в пуле процессов, битые отбрасываем."""
+
+        results = self.executor.map(
+            render_image,
+            [entry['image'] for entry in entries],
+            [self.base_dir] * len(entries))
+        rendered = []
+        for entry, (variants, error) in zip(entries, results):
+            if error:
+                self.error(entry['line'], error)
+                continue
+            entry['variants'] = variants
+            rendered.append(entry)
+        return rendered
+
+    def insert(self, entries):
+        """Рецепты, теги и ингредиенты пачки тремя bulk_create."""
+
+        recipes = Recipe.objects.bulk_create(
+            [entry['recipe'] for entry in entries])
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe_id=recipe.id, tag_id=tag_id)
+            for recipe, entry in zip(recipes, entries)
+            for tag_id in entry['tags'])
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(
+                recipe_id=recipe.id,
+                ingredient_id=ingredient_id,
+                amount=amount)
+            for recipe, entry in zip(recipes, entries)
+            for ingredient_id, amount in entry['amounts'].items())
+        ingredients_changed(recipe.id for recipe in recipes)
+        enqueue_fanout(recipes)
+        authors = Counter(recipe.author_id for recipe in recipes)
+        for author_id, count in authors.items():
+            update_user_counter(author_id, 'recipes_count', count)
+
+    def save(self, entries, line_number):
+        """Пишем пачку и контрольную точку в одной транзакции."""
+
+        saved_images = []
+        try:
+            for entry in entries:
+                images = save_variants({
+                    variant: {
+                        extension: ContentFile(content, name=name)
+                        for extension, (name, content) in files.items()}
+                    for variant, files in entry['variants'].items()})
+                saved_images.append(images)
+                recipe = entry['recipe']
+                recipe.image = images['full']['jpeg']
+                recipe.images = images
+            with transaction.atomic():
+                if entries:
+                    self.insert(entries)
+                self.write_checkpoint(line_number)
+        except Exception:
+            for images in saved_images:
+                delete_variants(images)
+            raise
+
+    def error(self, line_number, message):
+        self.errors += 1
+        self.stderr.write(f'Строка {line_number}: {message}')
+
+    def read_checkpoint(self):
+        if not self.checkpoint:
+            return 0
+        return ImportCheckpoint.objects.filter(
+            name=self.checkpoint).values_list('line', flat=True).first() or 0
+
+    def write_checkpoint(self, line_number):
+        if self.checkpoint:
+            ImportCheckpoint.objects.update_or_create(
+                name=self.checkpoint, defaults={'line': line_number})
+
+    def flush(self, batch, line_number):
+        entries = self.render_images(batch)
+        if not self.dry_run:
+            self.save(entries, line_number)
+            if entries:
+                bump_version(Recipe)
+        self.imported += len(entries)
+        elapsed = perf_counter() - self.started
+        self.stdout.write(
+            f'Строка {line_number}: загружено {self.imported}, '
+            f'ошибок {self.errors}, '
+            f'{self.processed / max(elapsed, 1e-9):.0f} строк/с')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'Нет файла {path}')
+        self.base_dir = os.path.dirname(os.path.abspath(path))
+        self.checkpoint = options['checkpoint']
+        self.dry_run = options['dry_run']
+        self.imported = self.errors = self.processed = 0
+        self.load_lookups()
+        skip = self.read_checkpoint()
+        if skip:
+            self.stdout.write(f'Продолжаем после строки {skip}')
+        batch_size = options['batch_size']
+        self.started = perf_counter()
+        batch = []
+        line_number = skip
+        with ProcessPoolExecutor(
+                max_workers=options['workers'],
+                initializer=django.setup
+        ) as self.executor, open(path, encoding='UTF-8') as file:
+            for line_number, line in enumerate(file, start=1):
+                if line_number <= skip or not line.strip():
+                    continue
+                self.processed += 1
+                try:
+                    entry = self.parse(line)
+                except ValueError as error:
+                    self.error(line_number, error)
+                    continue
+                entry['line'] = line_number
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    self.flush(batch, line_number)
+                    batch = []
+            self.flush(batch, line_number)
+        result = 'Проверено' if self.dry_run else 'Загружено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{result} рецептов: {self.imported}, ошибок: {self.errors}'))
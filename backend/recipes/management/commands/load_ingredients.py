@@ -1,20 +1,55 @@
-from csv import reader
+import csv
+import json
+import os
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 
+from api.cache import bump_version
 from recipes.models import Ingredient
 
 
+def read_csv(file):
+    for row in csv.reader(file):
+        if len(row) == 2:
+            yield row
+
+
+def read_json(file):
+    for item in json.load(file):
+        yield item['name'], item['measurement_unit']
+
+
+READERS = {'.csv': read_csv, '.json': read_json}
+
+
 class Command(BaseCommand):
-    help = 'Загрузка из csv файла'
-
-    def handle(self, *args, **kwargs):
-        with open(
-                'data/ingredients.csv', 'r',
-                encoding='UTF-8'
-        ) as ingredients:
-            for row in reader(ingredients):
-                if len(row) == 2:
-                    Ingredient.objects.get_or_create(
-                        name=row[0], measurement_unit=row[1],
-                    )
+    help = 'Загрузка ингредиентов из csv или json файла'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?', default='data/ingredients.csv',
+            help='Файл .csv (название, единица) или .json.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        reader = READERS.get(os.path.splitext(path)[1].lower())
+        if reader is None:
+            raise CommandError('Поддерживаются только .csv и .json')
+        with open(path, 'r', encoding='UTF-8') as file:
+            rows = {
+                (name.strip(), unit.strip())
+                for name, unit in reader(file) if name.strip()}
+        existing = set(
+            Ingredient.objects.values_list('name', 'measurement_unit'))
+        new = sorted(rows - existing)
+        # ignore_conflicts — на случай параллельной загрузки того же файла.
+        Ingredient.objects.bulk_create(
+            (Ingredient(name=name, measurement_unit=unit)
+             for name, unit in new),
+            batch_size=options['batch_size'],
+            ignore_conflicts=True)
+        if new:
+            bump_version(Ingredient)
+        self.stdout.write(self.style.SUCCESS(
+            f'Ингредиентов в файле: {len(rows)}, добавлено: {len(new)}'))
@@ -0,0 +1,37 @@
+from django.core.management import BaseCommand, CommandError
+
+from recipes.models import ShoppingCart, ShoppingListItem
+
+
+class Command(BaseCommand):
+    help = 'Пересобираем и сверяем сводные списки покупок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Только сверить, ничего не меняя.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        user_ids = sorted(
+            set(ShoppingCart.objects.filter(
+                user__isnull=False, recipe__isnull=False
+            ).values_list('user_id', flat=True))
+            | set(ShoppingListItem.objects.values_list(
+                'user_id', flat=True)))
+        batch_size = options['batch_size']
+        mismatched = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            if not options['check']:
+                ShoppingListItem.objects.rebuild(batch)
+            expected = ShoppingListItem.objects.computed(batch)
+            stored = ShoppingListItem.objects.stored(batch)
+            mismatched += len({
+                user_id for (user_id, _), _ in
+                expected.items() ^ stored.items()})
+        if mismatched:
+            raise CommandError(
+                f'Расхождения в списках покупок: {mismatched} польз.')
+        self.stdout.write(self.style.SUCCESS(
+            f'Списки покупок сверены: {len(user_ids)} польз.'))
@@ -0,0 +1,65 @@
+from django.contrib.auth import get_user_model
+from django.core.management import BaseCommand
+from django.db.models import (Count, F, IntegerField, OuterRef, Q,
+                              Subquery)
+from django.db.models.functions import Coalesce
+
+from recipes.models import FavoriteRecipe, Recipe, ShoppingCart, Subscribe
+
+User = get_user_model()
+
+
+def count_of(queryset, field):
+    """Подзапрос COUNT(*) по внешнему ключу field."""
+
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')}).order_by().values(
+            field).annotate(total=Count('*')).values('total'),
+        output_field=IntegerField()), 0)
+
+
+class Command(BaseCommand):
+    help = 'Сверяем и чиним счетчики популярности пачками'
+
+    COUNTERS = (
+        (Recipe, {
+            'favorites_count': (FavoriteRecipe.recipe.through.objects,
+                                'recipe'),
+            'in_carts_count': (ShoppingCart.recipe.through.objects,
+                               'recipe')}),
+        (User, {
+            'recipes_count': (Recipe.objects, 'author'),
+            'followers_count': (Subscribe.objects, 'author')}),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def reconcile(self, model, counters, batch_size):
+        annotations = {
+            f'real_{field}': count_of(queryset, related)
+            for field, (queryset, related) in counters.items()}
+        drift = Q()
+        for field in counters:
+            drift |= ~Q(**{field: F(f'real_{field}')})
+        fixed = 0
+        last_id = 0
+        while True:
+            ids = list(model.objects.filter(id__gt=last_id).order_by(
+                'id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return fixed
+            last_id = ids[-1]
+            objs = list(model.objects.filter(id__in=ids).annotate(
+                **annotations).filter(drift).only('id', *counters))
+            for obj in objs:
+                for field in counters:
+                    setattr(obj, field, getattr(obj, f'real_{field}'))
+            model.objects.bulk_update(objs, list(counters))
+            fixed += len(objs)
+
+    def handle(self, *args, **options):
+        for model, counters in self.COUNTERS:
+            fixed = self.reconcile(model, counters, options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f'{model._meta.verbose_name_plural}: исправлено {fixed}'))
@@ -0,0 +1,105 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from recipes.images import (ImageError, delete_variants, make_variants,
+                            save_variants)
+from recipes.management.worker import WorkerCommand
+from recipes.models import Recipe
+
+
+class Command(WorkerCommand):
+    help = 'Фоновая обработка картинок рецептов: варианты WebP/JPEG'
+    done_message = 'Обработано картинок: {}'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--backfill', action='store_true',
+            help='Поставить в очередь рецепты без вариантов картинки.')
+
+    def backfill(self):
+        recipes = Recipe.objects.filter(
+            image_status=Recipe.IMAGE_READY, images={}
+        ).exclude(image='').exclude(image__isnull=True)
+        queued = 0
+        for recipe in recipes.iterator():
+            recipe.image_source = recipe.image.name
+            recipe.image_status = Recipe.IMAGE_PENDING
+            recipe.image_attempts = 0
+            recipe.save(update_fields=(
+                'image_source', 'image_status', 'image_attempts'))
+            queued += 1
+        self.stdout.write(f'В очередь поставлено: {queued}')
+
+    def claim(self):
+        """Берем рецепт из очереди; UPDATE ... WHERE с тем же условием
+        отсекает воркеры, которые выбрали тот же рецепт одновременно.
+
+        Зависшие картинки (воркер упал) возвращаются в работу по таймауту,
+        исчерпавшие попытки — помечаются ошибкой."""
+
+        now = timezone.now()
+        stale = Q(
+            image_status=Recipe.IMAGE_PROCESSING,
+            image_claimed__lt=now - timedelta(
+                seconds=settings.IMAGE_JOB_TIMEOUT))
+        Recipe.objects.filter(
+            stale, image_attempts__gte=settings.IMAGE_JOB_ATTEMPTS
+        ).update(image_status=Recipe.IMAGE_FAILED)
+        queue = Q(image_status=Recipe.IMAGE_PENDING) | stale
+        for recipe in Recipe.objects.filter(queue).only(
+                'id', 'image_source').order_by('id')[:10]:
+            if Recipe.objects.filter(queue, id=recipe.id).update(
+                    image_status=Recipe.IMAGE_PROCESSING,
+                    image_claimed=now,
+                    image_attempts=F('image_attempts') + 1):
+                return recipe
+        return None
+
+    def process(self, recipe):
+        source = recipe.image_source
+        try:
+            with source.open('rb') as file:
+                images = save_variants(make_variants(file.read()))
+        except (ImageError, OSError) as error:
+            Recipe.objects.filter(
+                id=recipe.id, image_source=source.name
+            ).update(image_status=Recipe.IMAGE_FAILED)
+            self.stderr.write(f'Рецепт {recipe.id}: {error}')
+            return
+        with transaction.atomic():
+            current = Recipe.objects.select_for_update().filter(
+                id=recipe.id, image_source=source.name).first()
+            if current is None:
+                # Рецепт удалили или загрузили новую картинку.
+                delete_variants(images)
+                return
+            stale = {
+                name for files in current.images.values()
+                for name in files.values()}
+            if current.image:
+                stale.add(current.image.name)
+            current.image = images['full']['jpeg']
+            current.images = images
+            current.image_source = ''
+            current.image_status = Recipe.IMAGE_READY
+            current.save(update_fields=(
+                'image', 'images', 'image_source', 'image_status'))
+        for name in stale | {source.name}:
+            source.storage.delete(name)
+
+    def process_batch(self):
+        recipe = self.claim()
+        if recipe is None:
+            return 0
+        self.process(recipe)
+        return 1
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            self.backfill()
+        super().handle(*args, **options)
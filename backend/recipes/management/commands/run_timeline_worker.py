@@ -0,0 +1,23 @@
+from django.db import transaction
+
+from recipes.management.worker import WorkerCommand
+from recipes.models import TimelineEntry, TimelineFanout
+
+
+class Command(WorkerCommand):
+    help = 'Рассылка новых рецептов по лентам подписчиков'
+    done_message = 'Разослано рецептов: {}'
+
+    def process_batch(self):
+        """Берем задачу под блокировкой и удаляем ее в той же транзакции:
+        если воркер упадет, задача вернется в очередь."""
+
+        with transaction.atomic():
+            task = TimelineFanout.objects.select_for_update(
+                skip_locked=True, of=('self',)
+            ).select_related('recipe').order_by('id').first()
+            if task is None:
+                return 0
+            TimelineEntry.objects.fan_out(task.recipe)
+            task.delete()
+        return 1
@@ -0,0 +1,43 @@
+from time import sleep
+
+from django.core.management import BaseCommand
+
+
+class WorkerCommand(BaseCommand):
+    """Общий цикл фоновых обработчиков: опрашиваем очередь, пока она
+    не опустеет; без --once ждем новых задач.
+
+    Наследники реализуют process_batch()."""
+
+    done_message = 'Обработано: {}'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Обработать очередь и выйти.')
+        parser.add_argument(
+            '--sleep', type=float, default=1.0,
+            help='Пауза между опросами пустой очереди, сек.')
+
+    def process_batch(self):
+        """Обрабатываем очередную порцию задач, возвращаем их число;
+        0 — очередь пуста."""
+
+        raise NotImplementedError
+
+    def idle(self):
+        """Вызывается перед паузой на пустой очереди."""
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            count = self.process_batch()
+            if not count:
+                if options['once']:
+                    break
+                self.idle()
+                sleep(options['sleep'])
+                continue
+            processed += count
+        self.stdout.write(self.style.SUCCESS(
+            self.done_message.format(processed)))
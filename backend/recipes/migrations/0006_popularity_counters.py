@@ -0,0 +1,51 @@
+# Generated by Django 4.1.5 on 2026-10-17 06:34
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_of(queryset, field):
+    return Coalesce(Subquery(
+        queryset.filter(**{field: OuterRef('pk')}).order_by().values(
+            field).annotate(total=Count('*')).values('total'),
+        output_field=IntegerField()), 0)
+
+
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    FavoriteRecipe = apps.get_model('recipes', 'FavoriteRecipe')
+    ShoppingCart = apps.get_model('recipes', 'ShoppingCart')
+    Subscribe = apps.get_model('recipes', 'Subscribe')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Recipe.objects.update(
+        favorites_count=count_of(
+            FavoriteRecipe.recipe.through.objects, 'recipe'),
+        in_carts_count=count_of(
+            ShoppingCart.recipe.through.objects, 'recipe'))
+    User.objects.update(
+        recipes_count=count_of(Recipe.objects, 'author'),
+        followers_count=count_of(Subscribe.objects, 'author'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0005_cursor_pagination_indexes'),
+        ('users', '0002_popularity_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='В избранном'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='in_carts_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='В списках покупок'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
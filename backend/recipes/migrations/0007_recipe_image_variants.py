@@ -0,0 +1,28 @@
+# Generated by Django 4.1.5 on 2026-10-17 06:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_popularity_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='image_source',
+            field=models.FileField(blank=True, upload_to='recipe/sources/', verbose_name='Исходное изображение'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='image_status',
+            field=models.CharField(choices=[('ready', 'Готово'), ('pending', 'В очереди'), ('processing', 'Обрабатывается'), ('failed', 'Ошибка')], db_index=True, default='ready', max_length=10, verbose_name='Обработка изображения'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='images',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Варианты изображения'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.1.5 on 2026-10-17 06:45
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+# Предел PositiveSmallIntegerField в RecipeIngredient.amount.
+MAX_AMOUNT = 32767
+
+
+def merge_amounts(RecipeIngredient, keep_id, duplicate_ids):
+    """Переносим ингредиенты рецептов на оставшийся ингредиент.
+
+    Если в рецепте уже есть оставшийся ингредиент, складываем, но не
+    больше MAX_AMOUNT."""
+
+    kept = {
+        row.recipe_id: row for row in RecipeIngredient.objects.filter(
+            ingredient_id=keep_id)}
+    for row in RecipeIngredient.objects.filter(
+            ingredient_id__in=duplicate_ids):
+        target = kept.get(row.recipe_id)
+        if target is None:
+            row.ingredient_id = keep_id
+            row.save(update_fields=['ingredient'])
+            kept[row.recipe_id] = row
+        else:
+            target.amount = min(target.amount + row.amount, MAX_AMOUNT)
+            target.save(update_fields=['amount'])
+            row.delete()
+
+
+def rebuild_shopping_list(apps, keep_id, duplicate_ids):
+    """Списки покупок по ингредиенту считаем заново по корзинам:
+    суммы в рецептах могли упереться в MAX_AMOUNT."""
+
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    ShoppingListItem = apps.get_model('recipes', 'ShoppingListItem')
+    ShoppingListItem.objects.filter(
+        ingredient_id__in=[keep_id, *duplicate_ids]).delete()
+    ShoppingListItem.objects.bulk_create(
+        ShoppingListItem(
+            user_id=user_id, ingredient_id=keep_id, total_amount=total)
+        for user_id, total in RecipeIngredient.objects.filter(
+            ingredient_id=keep_id,
+            recipe__shopping_cart__user__isnull=False
+        ).values_list('recipe__shopping_cart__user').annotate(
+            total=Sum('amount')).order_by())
+
+
+def merge_duplicates(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    groups = Ingredient.objects.values('name', 'measurement_unit').annotate(
+        keep_id=Min('id'), total=Count('id')).filter(total__gt=1)
+    for group in groups:
+        keep_id = group['keep_id']
+        duplicate_ids = list(Ingredient.objects.filter(
+            name=group['name'],
+            measurement_unit=group['measurement_unit']
+        ).exclude(id=keep_id).values_list('id', flat=True))
+        merge_amounts(RecipeIngredient, keep_id, duplicate_ids)
+        rebuild_shopping_list(apps, keep_id, duplicate_ids)
+        Ingredient.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_recipe_image_variants'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='ingredient',
+            constraint=models.UniqueConstraint(fields=('name', 'measurement_unit'), name='unique_ingredient_name_unit'),
+        ),
+    ]
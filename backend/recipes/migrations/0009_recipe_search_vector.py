@@ -0,0 +1,51 @@
+# Generated by Django 4.1.5 on 2026-10-17 06:46
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+SEARCH_INDEX = 'recipe_search_vector_idx'
+# Заполнение векторов на момент миграции, дальше их пересчитывает
+# recipes.search.update_search_vectors.
+FILL_SQL = '''
+UPDATE recipes_recipe AS recipe SET search_vector =
+    setweight(to_tsvector('russian', recipe.name), 'A')
+    || setweight(to_tsvector('russian', recipe.text), 'B')
+    || setweight(to_tsvector('russian', coalesce((
+        SELECT string_agg(ingredient.name, ' ')
+        FROM recipes_recipeingredient AS item
+        JOIN recipes_ingredient AS ingredient
+            ON ingredient.id = item.ingredient_id
+        WHERE item.recipe_id = recipe.id), '')), 'C')
+'''
+
+
+def create_search_index(apps, schema_editor):
+    """GIN-индекс и заполнение векторов — только в PostgreSQL."""
+
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f'CREATE INDEX IF NOT EXISTS {SEARCH_INDEX} '
+        'ON recipes_recipe USING GIN (search_vector)')
+    schema_editor.execute(FILL_SQL)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX IF EXISTS {SEARCH_INDEX}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_unique_ingredient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Поисковый вектор'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
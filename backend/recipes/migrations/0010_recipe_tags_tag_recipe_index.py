@@ -0,0 +1,19 @@
+# Generated by Django 4.1.5 on 2026-10-17 06:47
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_recipe_search_vector'),
+    ]
+
+    # Таблица связей рецептов и тегов создается самим ManyToManyField,
+    # поэтому индекс (tag_id, recipe_id) для EXISTS заводим вручную.
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX recipe_tags_tag_recipe_idx '
+            'ON recipes_recipe_tags (tag_id, recipe_id)',
+            'DROP INDEX recipe_tags_tag_recipe_idx'),
+    ]
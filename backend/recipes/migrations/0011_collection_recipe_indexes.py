@@ -0,0 +1,24 @@
+# Generated by Django 4.1.5 on 2026-10-17 06:48
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_recipe_tags_tag_recipe_index'),
+    ]
+
+    # Фильтры и EXISTS идут от коллекции пользователя и покрыты уникальным
+    # индексом (коллекция, рецепт). Обратный нужен поиску по рецепту:
+    # чьи корзины пересчитать при его изменении, сверка счетчиков.
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX favorite_recipe_recipe_idx '
+            'ON recipes_favoriterecipe_recipe (recipe_id, favoriterecipe_id)',
+            'DROP INDEX favorite_recipe_recipe_idx'),
+        migrations.RunSQL(
+            'CREATE INDEX shopping_cart_recipe_idx '
+            'ON recipes_shoppingcart_recipe (recipe_id, shoppingcart_id)',
+            'DROP INDEX shopping_cart_recipe_idx'),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.5 on 2026-10-17 06:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0013_trending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyRecipe',
+            fields=[
+                ('recipe_id', models.IntegerField(primary_key=True, serialize=False, verbose_name='Рецепт')),
+                ('changed', models.DateTimeField(auto_now=True, verbose_name='Изменен')),
+            ],
+            options={
+                'verbose_name': 'Измененный рецепт',
+                'verbose_name_plural': 'Измененные рецепты',
+            },
+        ),
+    ]
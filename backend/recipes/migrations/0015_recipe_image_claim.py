@@ -0,0 +1,23 @@
+# Generated by Django 4.1.5 on 2026-10-17 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0014_similarity_dirty'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='image_attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Попыток обработки'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='image_claimed',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Взята в обработку'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-17 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0015_recipe_image_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Попыток'),
+        ),
+    ]
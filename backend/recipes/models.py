@@ -1,10 +1,16 @@
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchVectorField
 from django.core import validators
-from django.db import models
-
-from django.db.models.signals import post_save
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Max, Sum, When, Window
+from django.db.models.functions import RowNumber
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
 from django.dispatch import receiver
 
+from .search import update_search_vectors
+
 User = get_user_model()
 
 
@@ -20,6 +26,10 @@ class Ingredient(models.Model):
         ordering = ['name']
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['name', 'measurement_unit'],
+                name='unique_ingredient_name_unit')]
 
     def __str__(self):
         return f'{self.name}, {self.measurement_unit}.'
@@ -48,7 +58,47 @@ class Tag(models.Model):
         return self.name
 
 
+class RecipeManager(models.Manager):
+
+    def latest_by_author(self, author_ids, limit=None, fields=None):
+        """Последние limit рецептов каждого автора одним запросом.
+
+        ROW_NUMBER() по автору считаем в подзапросе и отсекаем снаружи:
+        фильтровать по оконной функции Django 4.1 не умеет."""
+
+        if not author_ids:
+            return {}
+        queryset = self.filter(author_id__in=author_ids)
+        if fields:
+            queryset = queryset.only('id', 'author_id', *fields)
+        if limit is None:
+            recipes = queryset.order_by('author_id', '-pub_date', '-id')
+        else:
+            sql, params = queryset.annotate(position=Window(
+                RowNumber(),
+                partition_by=F('author_id'),
+                order_by=(F('pub_date').desc(), F('id').desc()))
+            ).order_by().query.sql_with_params()
+            recipes = self.raw(
+                f'SELECT * FROM ({sql}) AS ranked WHERE position <= %s '
+                'ORDER BY author_id, position', (*params, limit))
+        grouped = {}
+        for recipe in recipes:
+            grouped.setdefault(recipe.author_id, []).append(recipe)
+        return grouped
+
+
 class Recipe(models.Model):
+    IMAGE_READY = 'ready'
+    IMAGE_PENDING = 'pending'
+    IMAGE_PROCESSING = 'processing'
+    IMAGE_FAILED = 'failed'
+    IMAGE_STATUS_CHOICES = (
+        (IMAGE_READY, 'Готово'),
+        (IMAGE_PENDING, 'В очереди'),
+        (IMAGE_PROCESSING, 'Обрабатывается'),
+        (IMAGE_FAILED, 'Ошибка'))
+
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -62,6 +112,31 @@ class Recipe(models.Model):
         upload_to='static/recipe/',
         blank=True,
         null=True)
+    image_source = models.FileField(
+        'Исходное изображение',
+        upload_to='recipe/sources/',
+        blank=True)
+    image_status = models.CharField(
+        'Обработка изображения',
+        max_length=10,
+        choices=IMAGE_STATUS_CHOICES,
+        default=IMAGE_READY,
+        db_index=True)
+    image_claimed = models.DateTimeField(
+        'Взята в обработку',
+        null=True,
+        blank=True)
+    image_attempts = models.PositiveSmallIntegerField(
+        'Попыток обработки',
+        default=0)
+    images = models.JSONField(
+        'Варианты изображения',
+        default=dict,
+        blank=True)
+    search_vector = SearchVectorField(
+        'Поисковый вектор',
+        null=True,
+        editable=False)
     text = models.TextField(
         'Описание рецепта')
     cooking_time = models.BigIntegerField(
@@ -80,11 +155,23 @@ class Recipe(models.Model):
     pub_date = models.DateTimeField(
         'Дата публикации',
         auto_now_add=True)
+    favorites_count = models.PositiveIntegerField(
+        'В избранном',
+        default=0)
+    in_carts_count = models.PositiveIntegerField(
+        'В списках покупок',
+        default=0)
+
+    objects = RecipeManager()
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ('-pub_date', )
+        indexes = [
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='recipe_pub_date_id_idx')]
 
     def __str__(self):
         return f'{self.author.email}, {self.name}'
@@ -135,6 +222,10 @@ class Subscribe(models.Model):
         verbose_name = 'Подписка'
         verbose_name_plural = 'Подписки'
         ordering = ['-id']
+        indexes = [
+            models.Index(
+                fields=['user', '-created', '-id'],
+                name='subscribe_user_created_idx')]
         constraints = [
             models.UniqueConstraint(
                 fields=['user', 'author'],
@@ -197,3 +288,555 @@ class ShoppingCart(models.Model):
             sender, instance, created, **kwargs):
         if created:
             return ShoppingCart.objects.create(user=instance)
+
+
+def update_user_counter(user_id, field, delta):
+    User.objects.filter(id=user_id).update(**{field: F(field) + delta})
+
+
+@receiver(post_save, sender=Recipe)
+def count_created_recipe(sender, instance, created, **kwargs):
+    if created:
+        update_user_counter(instance.author_id, 'recipes_count', 1)
+
+
+@receiver(post_delete, sender=Recipe)
+def count_deleted_recipe(sender, instance, **kwargs):
+    update_user_counter(instance.author_id, 'recipes_count', -1)
+
+
+@receiver(post_save, sender=Ingredient)
+def refresh_ingredient_search(sender, instance, created, **kwargs):
+    if not created:
+        recipe_ids = list(RecipeIngredient.objects.filter(
+            ingredient=instance).values_list('recipe_id', flat=True))
+        transaction.on_commit(lambda: update_search_vectors(recipe_ids))
+
+
+@receiver(post_save, sender=Subscribe)
+def count_created_subscription(sender, instance, created, **kwargs):
+    if created:
+        update_user_counter(instance.author_id, 'followers_count', 1)
+
+
+@receiver(post_delete, sender=Subscribe)
+def count_deleted_subscription(sender, instance, **kwargs):
+    update_user_counter(instance.author_id, 'followers_count', -1)
+
+
+class ShoppingListItemManager(models.Manager):
+    """Инкрементальное обновление сводного списка покупок."""
+
+    def add_amounts(self, user_ids, amounts):
+        """Прибавляем amounts {ingredient_id: дельта} каждому из user_ids."""
+
+        amounts = {
+            ingredient_id: delta
+            for ingredient_id, delta in amounts.items() if delta}
+        if not user_ids or not amounts:
+            return
+        with transaction.atomic():
+            self.bulk_create(
+                (self.model(user_id=user_id, ingredient_id=ingredient_id)
+                 for user_id in user_ids
+                 for ingredient_id, delta in amounts.items() if delta > 0),
+                ignore_conflicts=True)
+            items = self.filter(
+                user_id__in=user_ids, ingredient_id__in=amounts)
+            items.update(total_amount=F('total_amount') + Case(
+                *(When(ingredient_id=ingredient_id, then=delta)
+                  for ingredient_id, delta in amounts.items()),
+                default=0))
+            items.filter(total_amount__lte=0).delete()
+
+    def change_cart(self, cart_ids, recipe_ids, sign):
+        """Рецепты recipe_ids добавили (sign=1) в каждую из корзин
+        cart_ids или убрали (sign=-1) из них."""
+
+        user_ids = list(ShoppingCart.objects.filter(
+            id__in=cart_ids).values_list('user_id', flat=True))
+        amounts = RecipeIngredient.objects.filter(
+            recipe_id__in=recipe_ids).values_list(
+                'ingredient_id').annotate(total=Sum('amount')).order_by()
+        self.add_amounts(
+            user_ids,
+            {ingredient_id: sign * total for ingredient_id, total in amounts})
+
+    def change_recipe(self, recipe, old_amounts, new_amounts):
+        """Переносим изменение ингредиентов рецепта в списки покупок."""
+
+        deltas = {
+            ingredient_id: (
+                new_amounts.get(ingredient_id, 0)
+                - old_amounts.get(ingredient_id, 0))
+            for ingredient_id in old_amounts.keys() | new_amounts.keys()}
+        user_ids = list(ShoppingCart.objects.filter(
+            recipe=recipe).values_list('user_id', flat=True))
+        self.add_amounts(user_ids, deltas)
+
+    def computed(self, user_ids):
+        """Эталонный список покупок, посчитанный по корзинам."""
+
+        return {
+            (user_id, ingredient_id): total
+            for user_id, ingredient_id, total
+            in RecipeIngredient.objects.filter(
+                recipe__shopping_cart__user__in=user_ids
+            ).values_list(
+                'recipe__shopping_cart__user', 'ingredient'
+            ).annotate(total=Sum('amount')).order_by()}
+
+    def stored(self, user_ids):
+        return {
+            (user_id, ingredient_id): total
+            for user_id, ingredient_id, total in self.filter(
+                user_id__in=user_ids
+            ).values_list('user_id', 'ingredient_id', 'total_amount')}
+
+    def rebuild(self, user_ids):
+        with transaction.atomic():
+            self.filter(user_id__in=user_ids).delete()
+            self.bulk_create(
+                self.model(
+                    user_id=user_id,
+                    ingredient_id=ingredient_id,
+                    total_amount=total)
+                for (user_id, ingredient_id), total
+                in self.computed(user_ids).items())
+
+
+class ShoppingListItem(models.Model):
+    """Сводный список покупок пользователя."""
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Пользователь')
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_list_items',
+        verbose_name='Ингредиент')
+    total_amount = models.IntegerField(
+        'Общее количество',
+        default=0)
+
+    objects = ShoppingListItemManager()
+
+    class Meta:
+        verbose_name = 'Позиция списка покупок'
+        verbose_name_plural = 'Позиции списка покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_shopping_list_item')]
+
+    def __str__(self):
+        return f'{self.user}: {self.ingredient} x {self.total_amount}'
+
+
+def cart_pairs(instance, reverse, pk_set):
+    """(id корзин, id рецептов) из аргументов m2m_changed."""
+
+    if reverse:
+        return pk_set, [instance.id]
+    return [instance.id], pk_set
+
+
+@receiver(m2m_changed, sender=ShoppingCart.recipe.through)
+def update_shopping_lists(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    """Любое изменение корзин — из API, админки или shell — сразу
+    в сводные списки покупок.
+
+    В pre_remove и pre_clear запоминаем, какие связи на самом деле есть:
+    remove() шлет все переданные id, а после clear() их уже не узнать."""
+
+    through = ShoppingCart.recipe.through
+    own, other = (
+        ('recipe_id', 'shoppingcart_id') if reverse
+        else ('shoppingcart_id', 'recipe_id'))
+    if action in ('pre_remove', 'pre_clear'):
+        links = through.objects.filter(**{own: instance.id})
+        if action == 'pre_remove':
+            links = links.filter(**{f'{other}__in': pk_set})
+        instance._removed_cart_links = set(
+            links.values_list(other, flat=True))
+        return
+    if action == 'post_add':
+        sign = 1
+    elif action in ('post_remove', 'post_clear'):
+        sign = -1
+        pk_set = instance.__dict__.pop('_removed_cart_links', set())
+    else:
+        return
+    if pk_set:
+        ShoppingListItem.objects.change_cart(
+            *cart_pairs(instance, reverse, list(pk_set)), sign)
+
+
+@receiver(pre_delete, sender=Recipe)
+def remove_recipe_from_shopping_lists(sender, instance, **kwargs):
+    ShoppingListItem.objects.change_recipe(
+        instance,
+        dict(instance.recipe.values_list('ingredient_id', 'amount')),
+        {})
+
+
+class ExportJob(models.Model):
+    """Фоновая выгрузка списка покупок."""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка'))
+    FORMAT_CHOICES = (
+        ('pdf', 'PDF'),
+        ('txt', 'Текст'),
+        ('csv', 'CSV'),
+        ('json', 'JSON'))
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='export_jobs',
+        verbose_name='Пользователь')
+    export_format = models.CharField(
+        'Формат',
+        max_length=10,
+        choices=FORMAT_CHOICES,
+        default='pdf')
+    status = models.CharField(
+        'Статус',
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=PENDING)
+    file = models.FileField(
+        'Файл',
+        upload_to='exports/',
+        blank=True)
+    error = models.TextField(
+        'Ошибка',
+        blank=True)
+    created = models.DateTimeField(
+        'Создана',
+        auto_now_add=True)
+    started = models.DateTimeField(
+        'Начата',
+        null=True,
+        blank=True)
+    attempts = models.PositiveSmallIntegerField(
+        'Попыток',
+        default=0)
+    finished = models.DateTimeField(
+        'Завершена',
+        null=True,
+        blank=True)
+
+    class Meta:
+        verbose_name = 'Выгрузка списка покупок'
+        verbose_name_plural = 'Выгрузки списка покупок'
+        ordering = ['-id']
+        indexes = [
+            models.Index(
+                fields=['status', 'id'],
+                name='export_job_status_idx')]
+
+    def __str__(self):
+        return f'{self.user}: {self.export_format}, {self.status}'
+
+
+class TimelineEntryManager(models.Manager):
+    """Лента рецептов от авторов, на которых подписан пользователь."""
+
+    def add_recipes(self, user_ids, recipes):
+        """Раскладываем рецепты (id, автор, дата) по лентам user_ids."""
+
+        self.bulk_create(
+            (TimelineEntry(
+                user_id=user_id, recipe_id=recipe_id,
+                author_id=author_id, pub_date=pub_date)
+             for user_id in user_ids
+             for recipe_id, author_id, pub_date in recipes),
+            batch_size=1000,
+            ignore_conflicts=True)
+
+    def trim(self, user_ids):
+        """Оставляем в каждой ленте TIMELINE_LENGTH последних записей."""
+
+        sql, params = self.filter(user_id__in=user_ids).annotate(
+            position=Window(
+                RowNumber(),
+                partition_by=F('user_id'),
+                order_by=(F('pub_date').desc(), F('recipe_id').desc()))
+        ).order_by().values('id', 'position').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {self.model._meta.db_table} WHERE id IN ('
+                f'SELECT id FROM ({sql}) AS ranked WHERE position > %s)',
+                (*params, settings.TIMELINE_LENGTH))
+
+    def fan_out(self, recipe):
+        """Рецепт в ленты всех подписчиков автора, пачками."""
+
+        follower_ids = Subscribe.objects.filter(
+            author_id=recipe.author_id
+        ).order_by('user_id').values_list('user_id', flat=True)
+        batch_size = settings.TIMELINE_FANOUT_BATCH
+        last_id = 0
+        while True:
+            batch = list(follower_ids.filter(user_id__gt=last_id)[
+                :batch_size])
+            if not batch:
+                return
+            self.add_recipes(
+                batch, [(recipe.id, recipe.author_id, recipe.pub_date)])
+            self.trim(batch)
+            last_id = batch[-1]
+
+    def backfill(self, user_id, author_id):
+        """После подписки — последние рецепты автора в ленту."""
+
+        self.add_recipes([user_id], Recipe.objects.filter(
+            author_id=author_id
+        ).order_by('-pub_date', '-id').values_list(
+            'id', 'author_id', 'pub_date')[:settings.TIMELINE_LENGTH])
+        self.trim([user_id])
+
+    def pull(self, user):
+        """Рецепты популярных авторов в ленту при чтении.
+
+        Им не делаем рассылку при публикации: подписчиков слишком много,
+        поэтому читатель сам забирает то, что вышло после его записей."""
+
+        author_ids = list(user.follower.filter(
+            author__followers_count__gte=(
+                settings.TIMELINE_FANOUT_MAX_FOLLOWERS)
+        ).values_list('author_id', flat=True))
+        if not author_ids:
+            return
+        recipes = Recipe.objects.filter(author_id__in=author_ids)
+        newest = self.filter(
+            user=user, author_id__in=author_ids
+        ).aggregate(newest=Max('pub_date'))['newest']
+        if newest is not None:
+            recipes = recipes.filter(pub_date__gt=newest)
+        recipes = list(recipes.order_by('-pub_date', '-id').values_list(
+            'id', 'author_id', 'pub_date')[:settings.TIMELINE_LENGTH])
+        if recipes:
+            self.add_recipes([user.id], recipes)
+            self.trim([user.id])
+
+
+class TimelineEntry(models.Model):
+    """Запись ленты: рецепт автора, на которого подписан пользователь."""
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='timeline',
+        verbose_name='Пользователь')
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Рецепт')
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор')
+    pub_date = models.DateTimeField(
+        'Дата публикации')
+
+    objects = TimelineEntryManager()
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи ленты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_timeline_entry')]
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date', '-recipe'],
+                name='timeline_user_pub_date_idx')]
+
+    def __str__(self):
+        return f'{self.user}: {self.recipe_id}'
+
+
+class TimelineFanout(models.Model):
+    """Очередь рассылки нового рецепта по лентам подписчиков."""
+
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Рецепт')
+    created = models.DateTimeField(
+        'Создана',
+        auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Рассылка в ленты'
+        verbose_name_plural = 'Рассылки в ленты'
+
+
+def enqueue_fanout(recipes):
+    """Новые рецепты в очередь рассылки, кроме популярных авторов."""
+
+    authors = set(User.objects.filter(
+        id__in={recipe.author_id for recipe in recipes},
+        followers_count__gt=0,
+        followers_count__lt=settings.TIMELINE_FANOUT_MAX_FOLLOWERS
+    ).values_list('id', flat=True))
+    TimelineFanout.objects.bulk_create(
+        TimelineFanout(recipe=recipe) for recipe in recipes
+        if recipe.author_id in authors)
+
+
+@receiver(post_save, sender=Recipe)
+def fan_out_created_recipe(sender, instance, created, **kwargs):
+    if created:
+        enqueue_fanout([instance])
+
+
+@receiver(post_save, sender=Subscribe)
+def backfill_timeline(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: TimelineEntry.objects.backfill(
+            instance.user_id, instance.author_id))
+
+
+@receiver(post_delete, sender=Subscribe)
+def clear_timeline(sender, instance, **kwargs):
+    TimelineEntry.objects.filter(
+        user_id=instance.user_id, author_id=instance.author_id).delete()
+
+
+class RecipeActivity(models.Model):
+    """Добавление рецепта в избранное или корзину, для рейтинга."""
+
+    FAVORITE = 'favorite'
+    CART = 'cart'
+    KIND_CHOICES = (
+        (FAVORITE, 'Избранное'),
+        (CART, 'Корзина'))
+
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Рецепт')
+    kind = models.CharField(
+        'Действие',
+        max_length=10,
+        choices=KIND_CHOICES)
+    created = models.DateTimeField(
+        'Когда',
+        auto_now_add=True,
+        db_index=True)
+
+    class Meta:
+        verbose_name = 'Действие с рецептом'
+        verbose_name_plural = 'Действия с рецептами'
+
+
+class RecipeScore(models.Model):
+    """Рейтинг популярных рецептов: общий (tag пуст) и по тегам.
+
+    Пересчитывается командой compute_trending."""
+
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Рецепт')
+    tag = models.ForeignKey(
+        Tag,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='Тег')
+    score = models.FloatField(
+        'Рейтинг')
+
+    class Meta:
+        verbose_name = 'Рейтинг рецепта'
+        verbose_name_plural = 'Рейтинги рецептов'
+        indexes = [
+            models.Index(
+                fields=['tag', '-score'],
+                name='recipe_score_tag_score_idx')]
+
+
+class DirtyRecipeManager(models.Manager):
+
+    def mark(self, recipe_ids):
+        self.bulk_create(
+            (DirtyRecipe(recipe_id=recipe_id) for recipe_id in recipe_ids),
+            update_conflicts=True,
+            unique_fields=['recipe_id'],
+            update_fields=['changed'])
+
+
+class DirtyRecipe(models.Model):
+    """Рецепт, измененный после сборки индекса похожих рецептов.
+
+    Пока индекс не пересобран, такие рецепты считаются по БД."""
+
+    recipe_id = models.IntegerField(
+        'Рецепт',
+        primary_key=True)
+    changed = models.DateTimeField(
+        'Изменен',
+        auto_now=True)
+
+    objects = DirtyRecipeManager()
+
+    class Meta:
+        verbose_name = 'Измененный рецепт'
+        verbose_name_plural = 'Измененные рецепты'
+
+
+def ingredients_changed(recipe_ids):
+    """Состав рецептов поменялся: поисковый вектор и индекс похожих."""
+
+    recipe_ids = list(recipe_ids)
+    update_search_vectors(recipe_ids)
+    DirtyRecipe.objects.mark(recipe_ids)
+
+
+@receiver(post_delete, sender=Recipe)
+def forget_deleted_recipe(sender, instance, **kwargs):
+    DirtyRecipe.objects.mark([instance.id])
+
+
+class ImportCheckpoint(models.Model):
+    """Последняя загруженная строка импорта рецептов.
+
+    Пишется в одной транзакции с пачкой рецептов: после сбоя импорт
+    продолжается ровно с первой незагруженной строки."""
+
+    name = models.CharField(
+        'Импорт',
+        max_length=255,
+        unique=True)
+    line = models.PositiveIntegerField(
+        'Последняя строка')
+
+    class Meta:
+        verbose_name = 'Контрольная точка импорта'
+        verbose_name_plural = 'Контрольные точки импорта'
+
+    def __str__(self):
+        return f'{self.name}: {self.line}'
@@ -0,0 +1,66 @@
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.db.models.functions import Lower
+from django.dispatch import receiver
+
+SEARCH_CONFIG = 'russian'
+SEARCH_INDEX = 'recipe_search_vector_idx'
+SQLITE_LOWER = 'unicode_lower'
+
+# Вес A — название, B — описание, C — названия ингредиентов.
+UPDATE_SQL = f'''
+UPDATE recipes_recipe AS recipe SET search_vector =
+    setweight(to_tsvector('{SEARCH_CONFIG}', recipe.name), 'A')
+    || setweight(to_tsvector('{SEARCH_CONFIG}', recipe.text), 'B')
+    || setweight(to_tsvector('{SEARCH_CONFIG}', coalesce((
+        SELECT string_agg(ingredient.name, ' ')
+        FROM recipes_recipeingredient AS item
+        JOIN recipes_ingredient AS ingredient
+            ON ingredient.id = item.ingredient_id
+        WHERE item.recipe_id = recipe.id), '')), 'C')
+'''
+
+
+def is_supported(using=connection):
+    """Полнотекстовый поиск есть только в PostgreSQL."""
+
+    return using.vendor == 'postgresql'
+
+
+def update_search_vectors(recipe_ids=None, using=connection):
+    """Пересчитываем поисковый вектор рецептов (None — всех).
+
+    Вектор зависит от ингредиентов, поэтому считаем его одним UPDATE
+    уже после их записи."""
+
+    if not is_supported(using):
+        return
+    with using.cursor() as cursor:
+        if recipe_ids is None:
+            cursor.execute(UPDATE_SQL)
+        else:
+            cursor.execute(
+                UPDATE_SQL + ' WHERE recipe.id = ANY(%s)',
+                [list(recipe_ids)])
+
+
+def unicode_lower(value):
+    return None if value is None else value.lower()
+
+
+@receiver(connection_created)
+def register_sqlite_lower(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function(
+            SQLITE_LOWER, 1, unicode_lower, deterministic=True)
+
+
+class UnicodeLower(Lower):
+    """LOWER для поиска без полнотекстового индекса.
+
+    Встроенные LOWER и LIKE в SQLite меняют регистр только у латиницы,
+    поэтому там зовем str.lower, зарегистрированный при подключении."""
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection, function=SQLITE_LOWER, **extra_context)
@@ -0,0 +1,302 @@
+import json
+import math
+import os
+import shutil
+import threading
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+
+from .models import DirtyRecipe, RecipeIngredient
+
+CURRENT = 'CURRENT'
+META = 'meta.json'
+ARRAYS = (
+    'recipe_ids', 'recipe_sizes', 'ingredient_ids', 'idf',
+    'csc_indptr', 'csc_indices', 'csc_data')
+KEEP_BUILDS = 2
+
+_lock = threading.Lock()
+_index = None
+
+
+def idf_weights(document_frequency, recipes_count):
+    """Сглаженный IDF: ингредиент не из индекса весит больше всех."""
+
+    return np.log((1 + recipes_count) / (1 + document_frequency)) + 1
+
+
+class SimilarityIndex:
+    """Индекс похожих рецептов: L2-нормированные TF-IDF векторы
+    рецептов по ингредиентам, сложенные по столбцам (CSC): для каждого
+    ингредиента — рецепты с ним и веса. Те же списки рецептов служат
+    обратным индексом для поиска по продуктам.
+
+    Массивы открываем через mmap: страницы файла общие для всех процессов.
+    """
+
+    def __init__(self, arrays, meta, path=None):
+        self.path = path
+        self.meta = meta
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.recipes_count = len(self.recipe_ids)
+
+    @classmethod
+    def open(cls, path):
+        # asarray снимает обертку memmap: данные те же, срезы дешевле.
+        arrays = {
+            name: np.asarray(np.load(
+                os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+            for name in ARRAYS}
+        with open(os.path.join(path, META), encoding='UTF-8') as file:
+            meta = json.load(file)
+        return cls(arrays, meta, path)
+
+    @classmethod
+    def empty(cls):
+        arrays = {name: np.zeros(0, dtype=np.int32) for name in ARRAYS}
+        arrays['csc_indptr'] = np.zeros(1, dtype=np.int64)
+        return cls(arrays, {})
+
+    @staticmethod
+    def find(ids, values):
+        """Позиции values в отсортированном ids, -1 для отсутствующих."""
+
+        values = np.asarray(values, dtype=np.int64)
+        if not len(ids):
+            return np.full(len(values), -1)
+        positions = np.searchsorted(ids, values)
+        positions[positions == len(ids)] = 0
+        return np.where(ids[positions] == values, positions, -1)
+
+    def postings(self, position):
+        """Позиции рецептов с ингредиентом и их веса."""
+
+        start = self.csc_indptr[position]
+        end = self.csc_indptr[position + 1]
+        return self.csc_indices[start:end], self.csc_data[start:end]
+
+    def vectors(self, ingredient_sets):
+        """Векторы рецептов по их ингредиентам из БД, с весами индекса.
+
+        Ключ ингредиента — позиция в индексе или ('new', id)."""
+
+        all_ids = sorted({
+            ingredient_id
+            for ingredient_ids in ingredient_sets.values()
+            for ingredient_id in ingredient_ids})
+        positions = dict(zip(
+            all_ids, self.find(self.ingredient_ids, all_ids).tolist()))
+        missing = float(idf_weights(0, self.recipes_count))
+        vectors = {}
+        for recipe_id, ingredient_ids in ingredient_sets.items():
+            vector = {}
+            for ingredient_id in ingredient_ids:
+                position = positions[ingredient_id]
+                if position < 0:
+                    vector[('new', ingredient_id)] = missing
+                else:
+                    vector[position] = float(self.idf[position])
+            norm = math.sqrt(sum(weight ** 2 for weight in vector.values()))
+            vectors[recipe_id] = {
+                key: weight / norm for key, weight in vector.items()}
+        return vectors
+
+    def scores(self, vector):
+        """Косинус вектора со всеми рецептами индекса: обходим только
+        списки рецептов по ингредиентам запроса."""
+
+        scores = np.zeros(self.recipes_count, dtype=np.float32)
+        for position, weight in vector.items():
+            if isinstance(position, tuple):
+                continue
+            recipes, weights = self.postings(position)
+            scores[recipes] += np.float32(weight) * weights
+        return scores
+
+    def threshold(self, vector, scores, limit):
+        """Нижняя граница limit-го сходства по рецептам самых редких
+        ингредиентов запроса: дальше смотрим только рецепты не хуже нее,
+        а не все, где есть хотя бы соль."""
+
+        columns = sorted(
+            (position for position in vector
+             if not isinstance(position, tuple)),
+            key=lambda position: (
+                self.csc_indptr[position + 1] - self.csc_indptr[position]))
+        seeds = np.zeros(0, dtype=self.csc_indices.dtype)
+        for position in columns:
+            seeds = np.union1d(seeds, self.postings(position)[0])
+            found = scores[seeds]
+            found = found[found > 0]
+            if len(found) >= limit:
+                return np.partition(found, len(found) - limit)[-limit]
+        return np.finfo(np.float32).tiny
+
+    def top(self, vector, scores, limit):
+        """Лучшие limit рецептов: [(id рецепта, сходство)] по убыванию."""
+
+        candidates = np.flatnonzero(
+            scores >= self.threshold(vector, scores, limit))
+        if len(candidates) > limit:
+            candidates = candidates[
+                np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.lexsort((
+            self.recipe_ids[candidates], -scores[candidates]))]
+        return list(zip(
+            self.recipe_ids[candidates].tolist(),
+            scores[candidates].tolist()))
+
+
+def index_dir():
+    return settings.SIMILARITY_INDEX_DIR
+
+
+def current_build():
+    try:
+        with open(os.path.join(index_dir(), CURRENT),
+                  encoding='UTF-8') as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def get_index():
+    """Текущий индекс процесса; после новой сборки открываем ее."""
+
+    global _index
+    build = current_build()
+    if build is None:
+        return None
+    index = _index
+    if index is not None and os.path.basename(index.path) == build:
+        return index
+    with _lock:
+        if _index is None or os.path.basename(_index.path) != build:
+            _index = SimilarityIndex.open(os.path.join(index_dir(), build))
+        return _index
+
+
+def save_index(build, arrays, meta):
+    """Пишем сборку в отдельный каталог и атомарно переключаем CURRENT.
+
+    Старые сборки удаляем: у процессов, которые их еще читают,
+    открытые mmap остаются рабочими."""
+
+    root = index_dir()
+    path = os.path.join(root, build)
+    os.makedirs(path)
+    for name in ARRAYS:
+        np.save(os.path.join(path, f'{name}.npy'), arrays[name])
+    with open(os.path.join(path, META), 'w', encoding='UTF-8') as file:
+        json.dump(meta, file)
+    temporary = os.path.join(root, f'{CURRENT}.tmp')
+    with open(temporary, 'w', encoding='UTF-8') as file:
+        file.write(build)
+    os.replace(temporary, os.path.join(root, CURRENT))
+    builds = sorted(
+        name for name in os.listdir(root)
+        if os.path.isdir(os.path.join(root, name)))
+    for name in builds[:-KEEP_BUILDS]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def ingredient_sets(recipe_ids):
+    sets = defaultdict(list)
+    for recipe_id, ingredient_id in RecipeIngredient.objects.filter(
+            recipe_id__in=recipe_ids).values_list(
+                'recipe_id', 'ingredient_id'):
+        sets[recipe_id].append(ingredient_id)
+    return sets
+
+
+def similar_recipes(recipe_id, limit):
+    """Похожие рецепты: [(id рецепта, сходство)] по убыванию сходства.
+
+    Ингредиенты самого рецепта и рецептов, измененных после сборки
+    индекса, берем из БД; устаревшие строки индекса обнуляем.
+    Без индекса сравниваем только с измененными рецептами."""
+
+    if limit < 1:
+        return []
+    index = get_index() or SimilarityIndex.empty()
+    dirty = set(DirtyRecipe.objects.values_list('recipe_id', flat=True))
+    dirty.discard(recipe_id)
+    vectors = index.vectors(ingredient_sets([recipe_id, *dirty]))
+    vector = vectors.pop(recipe_id, None)
+    if not vector:
+        return []
+    results = []
+    if index.recipes_count:
+        scores = index.scores(vector)
+        exclude = index.find(index.recipe_ids, [recipe_id, *dirty])
+        scores[exclude[exclude >= 0]] = 0
+        results = index.top(vector, scores, limit)
+    for other_id, other in vectors.items():
+        score = sum(
+            weight * other.get(key, 0) for key, weight in vector.items())
+        if score > 0:
+            results.append((other_id, score))
+    results.sort(key=lambda item: (-item[1], item[0]))
+    return results[:limit]
+
+
+def ranked_chunks(missing, sizes, chunk_size):
+    """Позиции кандидатов пачками по chunk_size: по возрастанию missing,
+    при равенстве — сначала рецепты больше (продукты покрывают большую
+    долю), затем по позиции.
+
+    Сколько докупить — небольшое целое: целиком не сортируем, а берем
+    корзины missing подряд, пока не наберется пачка."""
+
+    totals = np.cumsum(np.bincount(missing))
+    low, done = 0, 0
+    while low < len(totals):
+        high = min(
+            np.searchsorted(totals, done + chunk_size), len(totals) - 1)
+        selected = np.flatnonzero((missing >= low) & (missing <= high))
+        selected = selected[np.lexsort((-sizes[selected], missing[selected]))]
+        for start in range(0, len(selected), chunk_size):
+            yield selected[start:start + chunk_size]
+        low, done = high + 1, totals[high]
+
+
+def pantry_recipes(ingredient_ids, chunk_size):
+    """Рецепты, в которых есть хоть один из ingredient_ids, пачками
+    [(id рецепта, сколько ингредиентов докупить)].
+
+    Первыми идут рецепты, где докупать меньше всего, при равенстве —
+    где продукты покрывают большую долю рецепта. Рецепты, измененные
+    после сборки индекса, считаем по БД, как в similar_recipes."""
+
+    index = get_index() or SimilarityIndex.empty()
+    pantry = set(ingredient_ids)
+    dirty = sorted(DirtyRecipe.objects.values_list('recipe_id', flat=True))
+    positions = index.find(index.ingredient_ids, sorted(pantry))
+    matched = np.bincount(np.concatenate([
+        index.postings(position)[0]
+        for position in positions[positions >= 0].tolist()
+    ] or [np.zeros(0, dtype=np.int32)]), minlength=index.recipes_count)
+    stale = index.find(index.recipe_ids, dirty)
+    matched[stale[stale >= 0]] = 0
+    candidates = np.flatnonzero(matched)
+    ids = index.recipe_ids[candidates]
+    sizes = index.recipe_sizes[candidates]
+    counts = matched[candidates]
+    extra = [
+        (recipe_id, len(recipe_ingredients),
+         len(pantry.intersection(recipe_ingredients)))
+        for recipe_id, recipe_ingredients in ingredient_sets(dirty).items()]
+    extra = np.array(
+        [row for row in extra if row[2]], dtype=np.int64).reshape(-1, 3)
+    if len(extra):
+        # Вставляем по месту, чтобы позиция кандидата шла по возрастанию id.
+        where = np.searchsorted(ids, extra[:, 0])
+        ids = np.insert(ids, where, extra[:, 0])
+        sizes = np.insert(sizes, where, extra[:, 1])
+        counts = np.insert(counts, where, extra[:, 2])
+    missing = sizes - counts
+    for chunk in ranked_chunks(missing, sizes, chunk_size):
+        yield list(zip(ids[chunk].tolist(), missing[chunk].tolist()))
@@ -0,0 +1,313 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.admin.sites import site
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from recipes.management.commands.run_image_worker import (
+    Command as ImageWorker)
+from recipes.management.commands.run_timeline_worker import (
+    Command as TimelineWorker)
+from recipes.models import (ImportCheckpoint, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingListItem, Subscribe,
+                            Tag, TimelineEntry, TimelineFanout)
+from users.models import User
+
+
+def create_user(email):
+    return User.objects.create_user(
+        email=email, username=email.split('@')[0],
+        first_name='Имя', last_name='Фамилия', password='password')
+
+
+class ImageWorkerClaimTest(TestCase):
+    """Очередь обработки картинок: зависшие и исчерпавшие попытки."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author@example.com')
+
+    def create_recipe(self, **fields):
+        return Recipe.objects.create(
+            author=self.author, name='Рецепт', text='Описание',
+            cooking_time=10, image_source='recipe/sources/image.jpg',
+            **fields)
+
+    def claim(self):
+        recipe = ImageWorker().claim()
+        if recipe is not None:
+            recipe.refresh_from_db()
+        return recipe
+
+    def ago(self, seconds):
+        return timezone.now() - timedelta(seconds=seconds)
+
+    def test_claims_pending(self):
+        recipe = self.create_recipe(image_status=Recipe.IMAGE_PENDING)
+        claimed = self.claim()
+        self.assertEqual(claimed, recipe)
+        self.assertEqual(claimed.image_status, Recipe.IMAGE_PROCESSING)
+        self.assertEqual(claimed.image_attempts, 1)
+        self.assertIsNotNone(claimed.image_claimed)
+        self.assertIsNone(self.claim())
+
+    def test_reclaims_stale(self):
+        self.create_recipe(
+            image_status=Recipe.IMAGE_PROCESSING, image_attempts=1,
+            image_claimed=self.ago(settings.IMAGE_JOB_TIMEOUT - 10))
+        self.assertIsNone(self.claim())
+        stale = self.create_recipe(
+            image_status=Recipe.IMAGE_PROCESSING, image_attempts=1,
+            image_claimed=self.ago(settings.IMAGE_JOB_TIMEOUT + 10))
+        claimed = self.claim()
+        self.assertEqual(claimed, stale)
+        self.assertEqual(claimed.image_attempts, 2)
+
+    def test_fails_after_attempts(self):
+        recipe = self.create_recipe(
+            image_status=Recipe.IMAGE_PROCESSING,
+            image_attempts=settings.IMAGE_JOB_ATTEMPTS,
+            image_claimed=self.ago(settings.IMAGE_JOB_TIMEOUT + 10))
+        self.assertIsNone(self.claim())
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.image_status, Recipe.IMAGE_FAILED)
+
+
+class ShoppingListTest(TestCase):
+    """Сводный список покупок совпадает с посчитанным по корзинам
+    после любых правок корзин и рецептов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author@example.com')
+        cls.users = [create_user(f'user{index}@example.com')
+                     for index in range(2)]
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {index}',
+                                      measurement_unit='г')
+            for index in range(3)]
+        cls.recipes = []
+        for index in range(2):
+            recipe = Recipe.objects.create(
+                author=cls.author, name=f'Рецепт {index}', text='Описание',
+                cooking_time=10)
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=10 * (index + 1) + position)
+                for position, ingredient in enumerate(
+                    cls.ingredients[index:index + 2]))
+            cls.recipes.append(recipe)
+
+    def assert_consistent(self):
+        user_ids = [user.id for user in self.users]
+        self.assertEqual(
+            ShoppingListItem.objects.stored(user_ids),
+            ShoppingListItem.objects.computed(user_ids))
+
+    def test_cart_changes(self):
+        first, second = self.recipes
+        cart = self.users[0].shopping_cart
+        cart.recipe.add(first, second)
+        self.assert_consistent()
+        self.assertTrue(ShoppingListItem.objects.exists())
+        cart.recipe.add(first)
+        cart.recipe.remove(second, second)
+        self.assert_consistent()
+        cart.recipe.remove(second)
+        self.assert_consistent()
+        first.shopping_cart.add(*(user.shopping_cart for user in self.users))
+        self.assert_consistent()
+        cart.recipe.set([second])
+        self.assert_consistent()
+        first.shopping_cart.clear()
+        cart.recipe.clear()
+        self.assert_consistent()
+        self.assertFalse(ShoppingListItem.objects.exists())
+
+    def test_recipe_changes(self):
+        first, second = self.recipes
+        for user in self.users:
+            user.shopping_cart.recipe.add(first, second)
+        RecipeIngredient.objects.filter(recipe=first).delete()
+        RecipeIngredient.objects.create(
+            recipe=first, ingredient=self.ingredients[2], amount=7)
+        ShoppingListItem.objects.change_recipe(
+            first, {self.ingredients[0].id: 10, self.ingredients[1].id: 11},
+            {self.ingredients[2].id: 7})
+        self.assert_consistent()
+        second.delete()
+        self.assert_consistent()
+
+    def test_admin_inline(self):
+        """Инлайн ингредиентов в админке тоже правит списки покупок."""
+
+        recipe = self.recipes[0]
+        self.users[0].shopping_cart.recipe.add(recipe)
+        first, second, third = self.ingredients
+
+        def save_inline():
+            recipe.recipe.filter(ingredient=first).update(amount=500)
+            recipe.recipe.filter(ingredient=second).delete()
+            RecipeIngredient.objects.create(
+                recipe=recipe, ingredient=third, amount=3)
+
+        form = SimpleNamespace(instance=recipe, save_m2m=lambda: None)
+        site._registry[Recipe].save_related(
+            RequestFactory().post('/admin/'), form,
+            [SimpleNamespace(save=save_inline)], True)
+        self.assert_consistent()
+
+
+class LatestByAuthorTest(TestCase):
+    """Последние рецепты авторов для подписок."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.authors = [create_user(f'author{index}@example.com')
+                       for index in range(2)]
+        for author, count in zip(cls.authors, (4, 2)):
+            for index in range(count):
+                Recipe.objects.create(
+                    author=author, name=f'Рецепт {index}', text='Описание',
+                    cooking_time=10)
+
+    def expected(self, author, limit=None):
+        return list(author.recipe.order_by(
+            '-pub_date', '-id').values_list('id', flat=True)[:limit])
+
+    def test_limit(self):
+        author_ids = [author.id for author in self.authors]
+        for limit in (None, 1, 3):
+            with self.subTest(limit=limit):
+                grouped = Recipe.objects.latest_by_author(
+                    author_ids, limit, ('name',))
+                self.assertEqual(
+                    {author_id: [recipe.id for recipe in recipes]
+                     for author_id, recipes in grouped.items()},
+                    {author.id: self.expected(author, limit)
+                     for author in self.authors})
+        self.assertEqual(Recipe.objects.latest_by_author([], 1), {})
+
+
+class TimelineTest(TestCase):
+    """Лента подписок: рассылка при публикации и добор при подписке."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author@example.com')
+        cls.users = [create_user(f'user{index}@example.com')
+                     for index in range(3)]
+        for index in range(4):
+            cls.create_recipe(index)
+
+    @classmethod
+    def create_recipe(cls, index):
+        return Recipe.objects.create(
+            author=cls.author, name=f'Рецепт {index}', text='Описание',
+            cooking_time=10)
+
+    def subscribe(self, *users):
+        with self.captureOnCommitCallbacks(execute=True):
+            for user in users:
+                Subscribe.objects.create(user=user, author=self.author)
+
+    def timeline(self, user):
+        return list(user.timeline.order_by(
+            '-pub_date', '-recipe_id').values_list('recipe_id', flat=True))
+
+    def latest(self, limit):
+        return list(self.author.recipe.order_by(
+            '-pub_date', '-id').values_list('id', flat=True)[:limit])
+
+    @override_settings(TIMELINE_LENGTH=3)
+    def test_backfill(self):
+        user = self.users[0]
+        self.subscribe(user)
+        self.assertEqual(self.timeline(user), self.latest(3))
+        Subscribe.objects.get(user=user).delete()
+        self.assertEqual(self.timeline(user), [])
+
+    @override_settings(TIMELINE_FANOUT_BATCH=2, TIMELINE_LENGTH=3)
+    def test_fan_out(self):
+        self.subscribe(*self.users)
+        recipe = self.create_recipe(4)
+        self.assertTrue(TimelineFanout.objects.filter(recipe=recipe).exists())
+        worker = TimelineWorker()
+        self.assertEqual(worker.process_batch(), 1)
+        self.assertEqual(worker.process_batch(), 0)
+        for user in self.users:
+            timeline = self.timeline(user)
+            self.assertEqual(timeline[0], recipe.id)
+            self.assertEqual(timeline, self.latest(3))
+
+    @override_settings(TIMELINE_FANOUT_MAX_FOLLOWERS=1)
+    def test_popular_author_is_pulled(self):
+        user = self.users[0]
+        self.subscribe(user)
+        recipe = self.create_recipe(4)
+        self.assertFalse(TimelineFanout.objects.exists())
+        self.assertNotIn(recipe.id, self.timeline(user))
+        TimelineEntry.objects.pull(user)
+        self.assertEqual(self.timeline(user)[0], recipe.id)
+
+
+class ImportRecipesTest(TestCase):
+    """Импорт рецептов: контрольная точка пишется вместе с пачкой."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author@example.com')
+        Tag.objects.create(name='Завтрак', color='#E26C2D', slug='breakfast')
+        Ingredient.objects.create(name='Соль', measurement_unit='г')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.directory)
+        media.enable()
+        self.addCleanup(media.disable)
+        Image.new('RGB', (2, 2), 'red').save(
+            os.path.join(self.directory, 'image.png'))
+        self.path = os.path.join(self.directory, 'recipes.jsonl')
+        with open(self.path, 'w', encoding='UTF-8') as file:
+            for index in range(3):
+                file.write(json.dumps({
+                    'author': self.author.email, 'name': f'Рецепт {index}',
+                    'text': 'Описание', 'cooking_time': 10,
+                    'image': 'image.png', 'tags': ['breakfast'],
+                    'ingredients': [{'name': 'Соль', 'measurement_unit': 'г',
+                                     'amount': 5}]}) + '\n')
+
+    def run_import(self):
+        call_command(
+            'import_recipes', self.path, checkpoint='recipes', workers=1,
+            batch_size=1, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def checkpoint(self):
+        return ImportCheckpoint.objects.get(name='recipes').line
+
+    def test_resume_after_failure(self):
+        with mock.patch(
+                'recipes.management.commands.import_recipes.enqueue_fanout',
+                side_effect=[None, DatabaseError]
+        ), self.assertRaises(DatabaseError):
+            self.run_import()
+        self.assertEqual(Recipe.objects.count(), 1)
+        self.assertEqual(self.checkpoint(), 1)
+        self.run_import()
+        self.assertEqual(
+            list(Recipe.objects.order_by('id').values_list(
+                'name', flat=True)),
+            ['Рецепт 0', 'Рецепт 1', 'Рецепт 2'])
+        self.assertEqual(self.checkpoint(), 3)
@@ -8,7 +8,8 @@ User = get_user_model()
 class UserAdmin(admin.ModelAdmin):
     list_display = (
         'id', 'username', 'email',
-        'first_name', 'last_name', 'date_joined',)
+        'first_name', 'last_name', 'date_joined',
+        'recipes_count', 'followers_count',)
     search_fields = ('email', 'username', 'first_name', 'last_name')
     list_filter = ('date_joined', 'email', 'first_name')
     empty_value_display = '-пусто-'
\ No newline at end of file